@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import docx
+import numpy as np
+import pandas as pd
+from google.cloud import datastore
+from sentiment import Handler, TranscriptProcessor, KeywordAnalyzer, SentimentAnalyzer, DataManager, Database
+
+# Benchmarks each stage of the pipeline (and the whole pipeline) on synthetic transcripts,
+# with an in-process fake datastore. Results are printed as JSON.
+
+categories = ["Macro", "Sector trend", "Financial metric - All", "Financial metric - Bank", "Regulation"]
+importance = ["Very Important", "Important", "Less so important"]
+filler_words = [
+    "the", "quarter", "we", "our", "growth", "strong", "weak", "demand", "customers", "expect",
+    "improved", "declined", "results", "guidance", "margin", "pressure", "year", "team", "good",
+    "challenging", "volume", "pricing", "costs", "record", "headwinds", "confident", "continue",
+]
+
+
+# Stands in for datastore.Client, keeping entities in memory
+class FakeClient:
+    def __init__(self):
+        self.entities = []
+        self.puts = 0
+        self.next_id = 1
+
+    def key(self, *path, namespace=None):
+        return datastore.Key(*path, project="benchmark", namespace=namespace)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        keys = [incomplete_key.completed_key(self.next_id + i) for i in range(num_ids)]
+        self.next_id += num_ids
+        return keys
+
+    def entity(self, key, exclude_from_indexes=()):
+        return datastore.Entity(key, exclude_from_indexes=exclude_from_indexes)
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        self.puts += 1
+        self.entities.extend(entities)
+
+    def delete_multi(self, keys):
+        keys = set(keys)
+        self.entities = [entity for entity in self.entities if entity.key not in keys]
+
+
+# Stands in for finBERT, returning deterministic pseudo-random probabilities (from a hash
+# of the text) so benchmarks run quickly without the model weights. VADER is still used.
+class StubSentimentAnalyzer(SentimentAnalyzer):
+    def __init__(self, **kwargs):
+        super().__init__(model_name="stub", **kwargs)
+
+    def get_probabilities(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        weights = np.frombuffer(digest[:3], dtype=np.uint8).astype(np.float64) + 1
+        return weights / weights.sum()
+
+    def get_batch_probabilities(self, texts):
+        return [self.get_probabilities(text) for text in texts]
+
+
+def generate_keywords(file_path, count, seed=0):
+    '''
+        Args:
+            file_path:  file path for the keyword excel file
+            count:      number of keywords
+            seed:       random seed
+
+        Returns:
+            List of the generated keywords
+
+        Results:
+            Saves a keyword excel file with the same headers as weighted_keywords.xlsx
+    '''
+    rng = random.Random(seed)
+    keywords = [f"{rng.choice(filler_words)} metric{i}" if i % 3 else f"term{i}" for i in range(count)]
+    pd.DataFrame({
+        "Keyword": keywords,
+        "Sector": [rng.choice(["All", "Industrials", "Banks"]) for _ in keywords],
+        "Key Word Category": [rng.choice(categories) for _ in keywords],
+        "Proposed": [rng.choice(importance) for _ in keywords],
+    }).to_excel(file_path, index=False)
+    return keywords
+
+
+def generate_transcript(file_path, paragraphs, keywords, keyword_rate=0.5, seed=0):
+    '''
+        Args:
+            file_path:      file path for the transcript (docx)
+            paragraphs:     number of paragraphs
+            keywords:       keywords to mention in paragraphs
+            keyword_rate:   fraction of paragraphs that mention a keyword
+            seed:           random seed
+
+        Results:
+            Saves a transcript of 'paragraphs' paragraphs of 2 to 8 sentences each, separated
+            by empty paragraphs like vendor transcripts
+    '''
+    rng = random.Random(seed)
+    document = docx.Document()
+    for _ in range(paragraphs):
+        sentences = []
+        for _ in range(rng.randint(2, 8)):
+            words = [rng.choice(filler_words) for _ in range(rng.randint(6, 25))]
+            if rng.random() < keyword_rate / 2:
+                words.insert(rng.randrange(len(words)), rng.choice(keywords))
+            sentences.append(" ".join(words).capitalize() + rng.choice([".", ".", ".", "!", "?"]))
+        document.add_paragraph(" ".join(sentences))
+        document.add_paragraph("")
+    document.save(file_path)
+
+
+def percentiles(latencies):
+    '''
+        Args:
+            latencies: list of latencies in seconds
+
+        Returns:
+            Dictionary of p50, p95, p99 and max latency in milliseconds
+    '''
+    values = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def peak_rss_mb():
+    '''
+        Returns:
+            The peak resident set size of this process so far, in MB. It only ever grows, so it
+            covers every stage run before it rather than any one of them
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(function, items, paragraphs_per_item, setup=None):
+    '''
+        Args:
+            function:               function called once per item
+            items:                  list of arguments for 'function'
+            paragraphs_per_item:    number of paragraphs each call handles (for throughput)
+            setup:                  function called (untimed) before each call, eg to clear caches
+
+        Returns:
+            Tuple of (result of the last call, dictionary of timings for the stage)
+    '''
+    latencies = []
+    result = None
+    total = 0.0
+    for item in items:
+        if setup is not None:
+            setup()
+        call_start = time.perf_counter()
+        result = function(item)
+        latencies.append(time.perf_counter() - call_start)
+        total += latencies[-1]
+    return result, {
+        "calls": len(items),
+        "seconds": total,
+        "paragraphs_per_second": len(items) * paragraphs_per_item / total if total else None,
+        **percentiles(latencies),
+    }
+
+
+def make_sentiment_analyzer(model_name):
+    ''' Returns StubSentimentAnalyzer if 'model_name' is 'stub', otherwise SentimentAnalyzer(model_name) '''
+    if model_name == "stub":
+        return StubSentimentAnalyzer()
+    return SentimentAnalyzer(model_name)
+
+
+def run_benchmark(paragraphs=500, keywords=200, repeats=3, model_name="stub", seed=0):
+    '''
+        Args:
+            paragraphs:     paragraphs per synthetic transcript
+            keywords:       keywords in the synthetic keyword file
+            repeats:        number of times each whole-transcript stage is run
+            model_name:     sentiment model name or path, or 'stub' for StubSentimentAnalyzer
+            seed:           random seed
+
+        Returns:
+            Dictionary of the benchmark configuration, timings for each stage and the peak RSS of
+            the whole run
+    '''
+    results = {
+        "config": {"paragraphs": paragraphs, "keywords": keywords, "repeats": repeats, "model": model_name, "seed": seed},
+        "stages": {},
+    }
+    stages = results["stages"]
+
+    with tempfile.TemporaryDirectory() as directory:
+        keywords_file_path = os.path.join(directory, "keywords.xlsx")
+        transcript_file_path = os.path.join(directory, "CC_BENCH US_Q12024_1_25_2024.docx")
+        keyword_list = generate_keywords(keywords_file_path, keywords, seed)
+        generate_transcript(transcript_file_path, paragraphs, keyword_list, seed=seed)
+
+        # Reading the whole transcript with python-docx, then with the streaming reader
+        # Handler uses by default (iter_docx_paragraphs)
+        _, stages["read_docx"] = measure(
+            lambda _: TranscriptProcessor(transcript_file_path).get_paragraphs(), range(repeats), paragraphs
+        )
+        streamed_paragraphs, stages["read_docx_streaming"] = measure(
+            lambda _: TranscriptProcessor(transcript_file_path, streaming=True).get_paragraphs(), range(repeats), paragraphs
+        )
+        transcript_processor = TranscriptProcessor(transcript_file_path)
+        paragraph_list, stages["split_paragraphs"] = measure(
+            lambda _: transcript_processor.split_paragraphs(), range(repeats), paragraphs
+        )
+        results["config"]["streaming_paragraphs_match"] = streamed_paragraphs == paragraph_list
+
+        keyword_analyzer = KeywordAnalyzer(keywords_file_path)
+        matches = []
+        _, stages["find_keywords"] = measure(
+            lambda paragraph: matches.append((paragraph, keyword_analyzer.find_keyword_ids(paragraph))),
+            paragraph_list, 1
+        )
+        matches = [(paragraph, found) for paragraph, found in matches if found]
+        results["config"]["matching_paragraphs"] = len(matches)
+
+        sentiment_analyzer = make_sentiment_analyzer(model_name)
+        sentiment_analyzer.analyze_sentiment("Warm up the model.")
+        # VADER scores of sentences are memoized, so the memo is cleared before every call
+        # (otherwise stages after the first would mostly measure dictionary lookups)
+        clear_sentences = lambda: sentiment_analyzer.sentence_compounds.clear()
+        _, stages["analyze_sentiment"] = measure(
+            lambda match: sentiment_analyzer.analyze_sentiment(match[0]), matches, 1, clear_sentences
+        )
+        _, stages["analyze_batch"] = measure(
+            lambda _: sentiment_analyzer.analyze_batch([paragraph for paragraph, _ in matches]),
+            range(repeats), len(matches), clear_sentences
+        )
+
+        data_manager = DataManager(fields=keyword_analyzer.get_fields(), keywords=keyword_analyzer.keywords)
+        for paragraph, keyword_ids in matches:
+            data_manager.add_paragraph(paragraph, 0.0, 0.0, [(keyword_id, None) for keyword_id in keyword_ids])
+        results["config"]["rows"] = len(data_manager.get_data())
+        csv_file_path = os.path.join(directory, "results.csv")
+        _, stages["save_as_csv"] = measure(
+            lambda _: data_manager.save_as_csv(csv_file_path), range(repeats), len(matches)
+        )
+
+        client = FakeClient()
+        handler = Handler(model_name=model_name)
+        handler.sentiment_analyzer = sentiment_analyzer
+        handler._database = Database(client=client)
+        output_file_path = os.path.join(directory, "output.csv")
+        _, stages["process_request"] = measure(
+            lambda _: handler.process_request(transcript_file_path, keywords_file_path, output_file_path=output_file_path),
+            range(repeats), paragraphs, clear_sentences
+        )
+        results["config"]["entities_uploaded"] = len(client.entities)
+        results["config"]["datastore_puts"] = client.puts
+
+    results["peak_rss_mb_cumulative"] = peak_rss_mb()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sentiment pipeline on synthetic transcripts")
+    parser.add_argument("--paragraphs", type=int, default=500, help="paragraphs per synthetic transcript")
+    parser.add_argument("--keywords", type=int, default=200, help="keywords in the synthetic keyword file")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each whole-transcript stage")
+    parser.add_argument("--model", default="stub", help="sentiment model name or path ('stub' runs without model weights)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", help="JSON file for the results (printed if not given)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.paragraphs, args.keywords, args.repeats, args.model, args.seed)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
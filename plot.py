@@ -1,13 +1,60 @@
 import pandas as pd
+import argparse
+import io
 import os
 import re
-import pandas as pd
-import matplotlib.pyplot as plt
+import sqlite3
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Score columns aggregated in the score index
+score_columns = ['Weighted Sentiment Score', 'Sentiment Score']
+
+def is_archive(source):
+    ''' Returns True if 'source' is a zip archive (rather than a directory) '''
+    return os.path.isfile(source) and zipfile.is_zipfile(source)
+
+
+def list_files(source):
+    '''
+    Args:
+        source: path to directory or zip archive
+
+    Returns:
+        Dictionary of file names (paths within the archive, for a zip archive) to their
+        modification times
+    '''
+    if is_archive(source):
+        with zipfile.ZipFile(source) as archive:
+            return {
+                info.filename: time.mktime(info.date_time + (0, 0, -1))
+                for info in archive.infolist() if not info.is_dir()
+            }
+    return {filename: os.path.getmtime(os.path.join(source, filename)) for filename in os.listdir(source)}
+
+
+def read_score_file(source, filename):
+    '''
+    Args:
+        source: path to directory or zip archive
+        filename: file name from list_files(source)
+
+    Returns:
+        The sentiment excel file as a DataFrame (read straight from the archive for a zip)
+    '''
+    if is_archive(source):
+        with zipfile.ZipFile(source) as archive:
+            return pd.read_excel(io.BytesIO(archive.read(filename)), engine='openpyxl')
+    return pd.read_excel(os.path.join(source, filename), engine='openpyxl')
+
 
 def group_files_by_company(directory):
     '''
     Args:
-        directory: path to directory with sentiment excel files for a given company
+        directory: path to directory (or zip archive) with sentiment excel files for a given company
         File naming format CC_{company}_Q{quarter}{year}_{month}_{day}_{year}.xlsx"
 
     Returns:
@@ -15,8 +62,8 @@ def group_files_by_company(directory):
         associated (files, quarter_year of files) as items.
     '''
     files_by_company = {}
-    for filename in os.listdir(directory):
-        match = re.search(r'CC_(.+)_Q(\d{1})(\d{4})', filename)
+    for filename in list_files(directory):
+        match = re.search(r'CC_(.+)_Q(\d{1})(\d{4})', os.path.basename(filename))
         if match:
             company = match.group(1)
             quarter_year = 'Q' + match.group(2) + match.group(3)
@@ -26,136 +73,344 @@ def group_files_by_company(directory):
     return files_by_company
 
 
-def plot_overall_weighted_sentiment(directory):
+def get_file_aggregates(df):
     '''
     Args:
-        directory: path to directory of sentiment excel files for a given company. 
-        Each file has headers such as: 'Weighted Sentiment Score', 'Keyword', 'Keyword Category'
-    
+        df: DataFrame of a sentiment excel file
+
+    Returns:
+        List of (column, category, sum, mean, count) for each column in score_columns, per
+        'Key Word Category' and for the whole file (category None). Columns missing from the
+        file are skipped.
+    '''
+    aggregates = []
+    for column in score_columns:
+        if column not in df:
+            continue
+        aggregates.append((column, None, float(df[column].sum()), float(df[column].mean()), int(df[column].count())))
+        if 'Key Word Category' not in df:
+            continue
+        grouped = df.groupby('Key Word Category')[column]
+        sums, means, counts = grouped.sum(), grouped.mean(), grouped.count()
+        for category in sums.index:
+            aggregates.append((column, category, float(sums[category]), float(means[category]), int(counts[category])))
+    return aggregates
+
+
+def update_score_index(directory, index_path=None):
+    '''
+    Args:
+        directory: path to directory (or zip archive) with sentiment excel files
+        index_path: path to the sqlite index (defaults to 'score_index.sqlite' in 'directory',
+                    or next to the archive)
+
     Result:
-        Line graph showing weighted sentiment scores for a given company over time.
-        Saved as a .png to 'directory'
+        Reads each sentiment excel file that is new or changed (by modification time) since it
+        was last indexed and saves its aggregates (see get_file_aggregates) to the index.
+        Files no longer in 'directory' are removed from the index.
 
     Returns:
-        None
+        index_path
     '''
-    files_by_company = group_files_by_company(directory)
+    if index_path is None:
+        if is_archive(directory):
+            index_path = os.path.splitext(directory)[0] + '_score_index.sqlite'
+        else:
+            index_path = os.path.join(directory, 'score_index.sqlite')
 
-    for company, file_quarter_pairs in files_by_company.items():
-        print(f'Processing files for company: {company}')  # Print the company name
+    connection = sqlite3.connect(index_path)
+    connection.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, mtime REAL, company TEXT, quarter_year TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS aggregates (filename TEXT, score_column TEXT, category TEXT, sum REAL, mean REAL, count INTEGER)')
+    connection.execute('CREATE INDEX IF NOT EXISTS aggregates_filename ON aggregates (filename)')
+    indexed = dict(connection.execute('SELECT filename, mtime FROM files'))
 
-        plt.clf()
-        sentiment_scores = []
+    mtimes = list_files(directory)
+    current = set()
+    for company, file_quarter_pairs in group_files_by_company(directory).items():
+        for filename, quarter_year in file_quarter_pairs:
+            current.add(filename)
+            mtime = mtimes[filename]
+            if indexed.get(filename) == mtime:
+                continue
+            print(f'Indexing {filename}')
+            aggregates = get_file_aggregates(read_score_file(directory, filename))
+            connection.execute('DELETE FROM aggregates WHERE filename = ?', (filename,))
+            connection.executemany('INSERT INTO aggregates VALUES (?, ?, ?, ?, ?, ?)', [(filename, *row) for row in aggregates])
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (filename, mtime, company, quarter_year))
+
+    for filename in set(indexed) - current:
+        connection.execute('DELETE FROM aggregates WHERE filename = ?', (filename,))
+        connection.execute('DELETE FROM files WHERE filename = ?', (filename,))
+    connection.commit()
+    connection.close()
+    return index_path
+
+
+def load_score_index(directory, index_path=None):
+    '''
+    Args:
+        directory: path to directory (or zip archive) with sentiment excel files
+        index_path: path to the sqlite index (see update_score_index)
 
+    Returns:
+        Dictionary with company names as keys and a list of (quarter_year, aggregates) as items,
+        sorted by quarter and year. aggregates maps (column, category) to (sum, mean, count),
+        with category None for the whole file. The index is updated first.
+    '''
+    index_path = update_score_index(directory, index_path)
+    connection = sqlite3.connect(index_path)
+
+    scores_by_company = {}
+    for company, file_quarter_pairs in group_files_by_company(directory).items():
         # Sort file_quarter_pairs based on quarter and year
         file_quarter_pairs.sort(key=lambda x: (int(x[1][2:]), int(x[1][1:2])))
+        scores_by_company[company] = []
         for filename, quarter_year in file_quarter_pairs:
-            df = pd.read_excel(os.path.join(directory, filename), engine='openpyxl')
-            total_sentiment_score = df['Weighted Sentiment Score'].sum()  # Calculate the sum instead of the average
-            sentiment_scores.append((quarter_year, total_sentiment_score))
+            rows = connection.execute(
+                'SELECT score_column, category, sum, mean, count FROM aggregates WHERE filename = ? ORDER BY category',
+                (filename,)
+            )
+            # NaN means are stored as NULL
+            aggregates = {
+                (column, category): (total, float('nan') if mean is None else mean, count)
+                for column, category, total, mean, count in rows
+            }
+            scores_by_company[company].append((quarter_year, aggregates))
+    connection.close()
+    return scores_by_company
+
+
+def get_category_means(aggregates, column):
+    '''
+    Args:
+        aggregates: dictionary of aggregates for a single file (see load_score_index)
+        column: score column, eg 'Sentiment Score'
+
+    Returns:
+        Dictionary of category to mean 'column' score for each category in the file,
+        in sorted category order (as from df.groupby('Key Word Category')[column].mean())
+    '''
+    return {
+        category: mean
+        for (score_column, category), (_, mean, _) in aggregates.items()
+        if score_column == column and category is not None
+    }
 
-        quarters, scores = zip(*sentiment_scores)
-        plt.plot(quarters, scores)
-        plt.xlabel('Quarter')
-        plt.ylabel('Average Weighted Sentiment Score')
-        plt.title(f'Average Weighted Sentiment Score per Quarter for {company}')
-        plt.savefig(os.path.join(directory, f'{company}_Weighted_Sentiment.png'))
 
+def render_overall_weighted_sentiment(company, file_scores, output_directory):
+    '''
+    Args:
+        company: company name
+        file_scores: list of (quarter_year, aggregates) for 'company' (see load_score_index)
+        output_directory: directory the .png is saved to
 
-def plot_individual_weighted_sentiment(directory):
+    Result:
+        Line graph showing weighted sentiment scores for 'company' over time.
+        Drawn on its own Figure (Agg), so companies can be rendered in parallel
+    '''
+    sentiment_scores = []
+    for quarter_year, aggregates in file_scores:
+        if ('Weighted Sentiment Score', None) not in aggregates:
+            continue
+        total_sentiment_score = aggregates[('Weighted Sentiment Score', None)][0]  # Calculate the sum instead of the average
+        sentiment_scores.append((quarter_year, total_sentiment_score))
+
+    if not sentiment_scores:
+        print(f'No weighted sentiment scores for company: {company}')
+        return
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    quarters, scores = zip(*sentiment_scores)
+    axes.plot(quarters, scores)
+    axes.set_xlabel('Quarter')
+    axes.set_ylabel('Average Weighted Sentiment Score')
+    axes.set_title(f'Average Weighted Sentiment Score per Quarter for {company}')
+    figure.savefig(os.path.join(output_directory, f'{company}_Weighted_Sentiment.png'))
+
+
+def render_category_sentiment(company, file_scores, output_directory, column, label, suffix):
     '''
     Args:
-        directory: path to directory of sentiment excel files for a given company. 
-        Each file has headers such as: 'Weighted Sentiment Score', 'Keyword', 'Keyword Category'
-    
+        company: company name
+        file_scores: list of (quarter_year, aggregates) for 'company' (see load_score_index)
+        output_directory: directory the .png is saved to
+        column: score column, eg 'Sentiment Score'
+        label: description of 'column' for the axis and title, eg 'Raw Sentiment Score'
+        suffix: end of the .png name, eg 'Raw_Sentiment_Categories'
+
     Result:
-        Line graph showing weighted sentiment scores for a given company over time.
+        Line graph showing average 'column' scores for 'company' over time.
         Scores are broken up by category (eg Finanical Metric, Macro, Sector Trend)
-        Saved as a .png to 'directory'
+        Drawn on its own Figure (Agg), so companies can be rendered in parallel
+    '''
+    sentiment_scores_by_category = {}
+    for quarter_year, aggregates in file_scores:
+        category_scores = get_category_means(aggregates, column)
 
-    Returns:
-        None
+        # Update the sentiment_scores_by_category dictionary
+        for category, score in category_scores.items():
+            if category in ["Financial metric - All", "Macro", "Sector trend"]:
+                if category not in sentiment_scores_by_category:
+                    sentiment_scores_by_category[category] = []
+                sentiment_scores_by_category[category].append((quarter_year, score))
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+
+    # Plot sentiment scores for each category
+    for category, scores in sentiment_scores_by_category.items():
+        quarters, category_scores = zip(*scores)
+        axes.plot(quarters, category_scores, label=category)
+
+    axes.set_ylim(0, 1)
+    axes.set_xlabel('Quarter')
+    axes.set_ylabel(f'Average {label}')
+    axes.set_title(f'Average {label} per Quarter for {company}')
+    axes.legend()
+    figure.savefig(os.path.join(output_directory, f'{company}_{suffix}.png'))
+
+
+def render_individual_weighted_sentiment(company, file_scores, output_directory):
+    ''' Weighted sentiment by category for 'company' (see render_category_sentiment) '''
+    render_category_sentiment(company, file_scores, output_directory, 'Weighted Sentiment Score',
+                              'Weighted Sentiment Score', 'Weighted_Sentiment_Categories')
+
+
+def render_individual_unweighted_sentiment(company, file_scores, output_directory):
+    ''' Unweighted sentiment by category for 'company' (see render_category_sentiment) '''
+    render_category_sentiment(company, file_scores, output_directory, 'Sentiment Score',
+                              'Raw Sentiment Score', 'Raw_Sentiment_Categories')
+
+
+def render_chart(task):
     '''
-    files_by_company = group_files_by_company(directory)
+    Args:
+        task: tuple of (render function, company, file_scores, output_directory)
 
-    for company, file_quarter_pairs in files_by_company.items():
-        print(f'Processing files for company: {company}')
+    Result:
+        Calls the render function for one chart (used by the process pool in render_all)
+    '''
+    render, company, file_scores, output_directory = task
+    print(f'Processing files for company: {company}')
+    render(company, file_scores, output_directory)
 
-        plt.clf()
-        sentiment_scores_by_category = {}
 
-        # Sort file_quarter_pairs based on quarter and year
-        file_quarter_pairs.sort(key=lambda x: (int(x[1][2:]), int(x[1][1:2])))
+def render_companies(source, render, index_path=None, output_directory=None):
+    '''
+    Args:
+        source: path to directory or zip archive of sentiment excel files
+        render: render function, eg render_overall_weighted_sentiment
+        index_path: path to the score index (see update_score_index)
+        output_directory: directory the .png files are saved to (see get_output_directory)
 
-        for filename, quarter_year in file_quarter_pairs:
-            df = pd.read_excel(os.path.join(directory, filename))
+    Result:
+        Renders one chart per company with 'render', one after another
+    '''
+    scores_by_company = load_score_index(source, index_path)
+    output_directory = get_output_directory(source, output_directory)
+    for company, file_scores in scores_by_company.items():
+        render_chart((render, company, file_scores, output_directory))
 
-            category_scores = df.groupby('Key Word Category')['Weighted Sentiment Score'].mean()
 
-            # Update the sentiment_scores_by_category dictionary
-            for category, score in category_scores.items():
-                if category in ["Financial metric - All", "Macro", "Sector trend"]:
-                    if category not in sentiment_scores_by_category:
-                        sentiment_scores_by_category[category] = []
-                    sentiment_scores_by_category[category].append((quarter_year, score))
+def render_all(source, index_path=None, output_directory=None, processes=None):
+    '''
+    Args:
+        source: path to directory or zip archive of sentiment excel files
+        index_path: path to the score index (see update_score_index)
+        output_directory: directory the .png files are saved to (see get_output_directory)
+        processes: number of worker processes (defaults to the number of CPUs)
 
-        # Plot sentiment scores for each category
-        for category, scores in sentiment_scores_by_category.items():
-            quarters, category_scores = zip(*scores)
-            plt.plot(quarters, category_scores, label=category)
+    Result:
+        Renders all three charts for every company, spread across a process pool
+    '''
+    scores_by_company = load_score_index(source, index_path)
+    output_directory = get_output_directory(source, output_directory)
+    renders = [render_overall_weighted_sentiment, render_individual_weighted_sentiment, render_individual_unweighted_sentiment]
+    tasks = [
+        (render, company, file_scores, output_directory)
+        for company, file_scores in scores_by_company.items()
+        for render in renders
+    ]
+    with ProcessPoolExecutor(processes) as executor:
+        # list() re-raises the first error from any chart
+        list(executor.map(render_chart, tasks))
 
-        plt.ylim(0, 1)
-        plt.xlabel('Quarter')
-        plt.ylabel('Average Weighted Sentiment Score')
-        plt.title(f'Average Weighted Sentiment Score per Quarter for {company}')
-        plt.legend()
-        plt.savefig(os.path.join(directory, f'{company}_Weighted_Sentiment_Categories.png'))
 
-def plot_individual_unweighted_sentiment(directory):
+def get_output_directory(source, output_directory=None):
+    '''
+    Returns:
+        'output_directory' if given, otherwise 'source' if it is a directory, or the directory
+        containing 'source' if it is a zip archive
+    '''
+    if output_directory is None:
+        output_directory = os.path.dirname(os.path.abspath(source)) if is_archive(source) else source
+    os.makedirs(output_directory, exist_ok=True)
+    return output_directory
+
+
+def plot_overall_weighted_sentiment(directory, index_path=None, output_directory=None):
     '''
     Args:
-        directory: path to directory of sentiment excel files for a given company. 
-        Each file has headers such as: 'Sentiment Score', 'Keyword', 'Keyword Category'
+        directory: path to directory (or zip archive) of sentiment excel files for a given company. 
+        Each file has headers such as: 'Weighted Sentiment Score', 'Keyword', 'Keyword Category'
+        index_path: path to the score index (see update_score_index)
+        output_directory: directory the .png files are saved to (see get_output_directory)
     
     Result:
-        Line graph showing unweighted sentiment scores for a given company over time.
+        Line graph showing weighted sentiment scores for a given company over time.
+        Saved as a .png to 'directory'
+
+    Returns:
+        None
+    '''
+    render_companies(directory, render_overall_weighted_sentiment, index_path, output_directory)
+
+
+def plot_individual_weighted_sentiment(directory, index_path=None, output_directory=None):
+    '''
+    Args:
+        directory: path to directory (or zip archive) of sentiment excel files for a given company. 
+        Each file has headers such as: 'Weighted Sentiment Score', 'Keyword', 'Keyword Category'
+        index_path: path to the score index (see update_score_index)
+        output_directory: directory the .png files are saved to (see get_output_directory)
+    
+    Result:
+        Line graph showing weighted sentiment scores for a given company over time.
         Scores are broken up by category (eg Finanical Metric, Macro, Sector Trend)
         Saved as a .png to 'directory'
 
     Returns:
         None
     '''
-    files_by_company = group_files_by_company(directory)
+    render_companies(directory, render_individual_weighted_sentiment, index_path, output_directory)
 
-    for company, file_quarter_pairs in files_by_company.items():
-        print(f'Processing files for company: {company}')
+def plot_individual_unweighted_sentiment(directory, index_path=None, output_directory=None):
+    '''
+    Args:
+        directory: path to directory (or zip archive) of sentiment excel files for a given company. 
+        Each file has headers such as: 'Sentiment Score', 'Keyword', 'Keyword Category'
+        index_path: path to the score index (see update_score_index)
+        output_directory: directory the .png files are saved to (see get_output_directory)
+    
+    Result:
+        Line graph showing unweighted sentiment scores for a given company over time.
+        Scores are broken up by category (eg Finanical Metric, Macro, Sector Trend)
+        Saved as a .png to 'directory'
 
-        plt.clf()
-        sentiment_scores_by_category = {}
+    Returns:
+        None
+    '''
+    render_companies(directory, render_individual_unweighted_sentiment, index_path, output_directory)
 
-        # Sort file_quarter_pairs based on quarter and year
-        file_quarter_pairs.sort(key=lambda x: (int(x[1][2:]), int(x[1][1:2])))
 
-        for filename, quarter_year in file_quarter_pairs:
-            df = pd.read_excel(os.path.join(directory, filename))
-
-            category_scores = df.groupby('Key Word Category')['Sentiment Score'].mean()
-
-            # Update the sentiment_scores_by_category dictionary
-            for category, score in category_scores.items():
-                if category in ["Financial metric - All", "Macro", "Sector trend"]:
-                    if category not in sentiment_scores_by_category:
-                        sentiment_scores_by_category[category] = []
-                    sentiment_scores_by_category[category].append((quarter_year, score))
-
-        # Plot sentiment scores for each category
-        for category, scores in sentiment_scores_by_category.items():
-            quarters, category_scores = zip(*scores)
-            plt.plot(quarters, category_scores, label=category)
-
-        plt.ylim(0, 1)
-        plt.xlabel('Quarter')
-        plt.ylabel('Average Raw Sentiment Score')
-        plt.title(f'Average Raw Sentiment Score per Quarter for {company}')
-        plt.legend()
-        plt.savefig(os.path.join(directory, f'{company}_Raw_Sentiment_Categories.png'))
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plot sentiment scores for each company')
+    parser.add_argument('source', help='directory or zip archive of sentiment excel files')
+    parser.add_argument('--output-dir', help='directory for the .png files')
+    parser.add_argument('--index', help='score index file')
+    parser.add_argument('--processes', type=int, help='number of worker processes')
+    args = parser.parse_args()
+    render_all(args.source, args.index, args.output_dir, args.processes)
@@ -1,16 +1,51 @@
-import pandas as pd
-import docx
+import time
+module_load_start = time.perf_counter()
+
 import csv
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-from torch.nn.functional import softmax
-import nltk
-from nltk.sentiment import SentimentIntensityAnalyzer
-from nltk.tokenize import sent_tokenize
-from google.cloud import datastore
+import argparse
+import contextlib
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import threading
+import traceback
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Heavy dependencies (pandas, docx, transformers, torch, nltk, google-cloud-datastore) are
+# imported where they are first used, so importing this module (and starting the CLI) is fast
+
+# Required nltk files (data path, package name), checked locally and only downloaded if missing
+nltk_requirements = [
+    ('sentiment/vader_lexicon.zip', 'vader_lexicon'),
+    ('tokenizers/punkt', 'punkt'),
+    ('tokenizers/punkt_tab', 'punkt_tab'),
+]
+nltk_checked = False
+
 
-# Required nltk files, only downloaded on first use
-nltk.download('vader_lexicon')
-nltk.download('punkt')
+def ensure_nltk_data():
+    '''
+        Results:
+            Downloads any nltk files in nltk_requirements that aren't already installed
+            (checked once per process, without going through the downloader)
+    '''
+    global nltk_checked
+    if nltk_checked:
+        return
+    import nltk
+    for path, package in nltk_requirements:
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            nltk.download(package, quiet=True)
+    nltk_checked = True
 
 # FRONTEND SHOULD ONLY INTERFACE WITH Handler.process_request()
 # FILE HANDLING AND OTHER SPECIFICS MAY NEED TO CHANGE DEPENDING ON FRONTEND
@@ -24,39 +59,256 @@ nltk.download('punkt')
 # Handles the process of receiving a transcript, analyzing for sentiment,
 # and uploading results to datastore
 class Handler:
-    def __init__(self):
-        self.sentiment_analyzer = SentimentAnalyzer()
-        self.database = Database("key.json")
+    # Number of keyword-matching paragraphs scored (and saved) at a time
+    chunk_size = 256
+
+    def __init__(self, model_name='ProsusAI/finBERT', cache_file_path=None, upload=True, key_filepath="key.json",
+                 backend='torch', instrumentation=None, streaming=True, layout='flat', cascade_threshold=None,
+                 cascade_calibration=(1.0, 0.0), windowed=False, store_file_path=None, score_all=False, threads=None,
+                 word_boundaries=False, batch_size=16):
+        '''
+            Args:
+                model_name:         sentiment model name or path
+                cache_file_path:    file path for a SentimentCache (None for no cache)
+                upload:             if False (offline), results are never uploaded and the
+                                    datastore client is never built
+                key_filepath:       datastore key file
+                backend:            sentiment model backend, 'torch', 'onnx' or 'onnx-int8'
+                instrumentation:    Instrumentation recording stage times and counters for each
+                                    request (None disables instrumentation)
+                streaming:          if True, transcript paragraphs are read from the docx as they
+                                    are processed rather than loading the whole document first
+                layout:             'flat' (a row per keyword per paragraph) or 'normalized' (rows
+                                    reference paragraphs saved once to a second file), see DataManager
+                cascade_threshold:  if given, paragraphs with a confident enough VADER score skip the
+                                    model (see SentimentAnalyzer)
+                cascade_calibration:(slope, intercept) from the mean VADER compound score to the
+                                    sentiment score in cascade mode (see check_cascade)
+                windowed:           if True, paragraphs longer than the model's limit are scored from
+                                    overlapping windows rather than truncated (see SentimentAnalyzer)
+                store_file_path:    file path for a ParagraphStore saving every scored paragraph, so
+                                    results can be rebuilt with other keywords or weights (see rejoin)
+                score_all:          if True, every paragraph is scored (and stored), not just those
+                                    matching keywords, so later keyword files can match any of them
+                threads:            intra-op threads for the sentiment model (None for the backend's
+                                    default, every CPU)
+                word_boundaries:    if True, keywords only match as whole words (see KeywordMatcher)
+                batch_size:         most paragraphs run through the model at once (unless windowed,
+                                    see SentimentAnalyzer)
+        '''
+        cache = SentimentCache(cache_file_path) if cache_file_path else None
+        self.sentiment_analyzer = SentimentAnalyzer(model_name, batch_size=batch_size, cache=cache, backend=backend,
+                                                    cascade_threshold=cascade_threshold,
+                                                    cascade_calibration=cascade_calibration, windowed=windowed, threads=threads)
+        self.instrumentation = instrumentation or NullInstrumentation()
+        self.sentiment_analyzer.instrumentation = self.instrumentation
+        self.upload_enabled = upload
+        self.streaming = streaming
+        self.layout = layout
+        self.store = ParagraphStore(store_file_path) if store_file_path else None
+        self.score_all = score_all
+        self.word_boundaries = word_boundaries
+        # Paragraphs of the request being processed, stored once it succeeds (see save_results)
+        self.store_items = None
+        self.key_filepath = key_filepath
+        self._database = None
         self.transcript_processor = None
         self.keyword_analyzer = None
         self.data_manager = None
 
-    # Company and date are currently unused, need to coordinate with frontend on how
-    # those are passed. They should be added to datastore entries and used for csv filename
-    def process_request(self, transcript_file_path, keywords_file_path, company=None, date=None):
+    @property
+    def database(self):
+        ''' Database, connected on first use '''
+        if self._database is None:
+            self._database = Database(self.key_filepath)
+        return self._database
+
+    # Company and date are currently only used for the csv filename, need to coordinate with
+    # frontend on how those are passed. They should also be added to datastore entries
+    def process_request(self, transcript_file_path, keywords_file_path, company=None, date=None, output_file_path=None):
         '''
             Args:
                 transcript_file_path:   file path containing transcript to be analyzed
                 keywords_file_path:     file path containing keywords to be analyzed
                 company:                Ticker of company for transcript
                 date:                   Date of transcript
+                output_file_path:       file path for the results, CSV, Parquet or Arrow by extension
+                                        (defaults to get_output_name(company, date))
+
+            Returns:
+                File path of the saved results
 
             Results:
                 The transcript is broken into paragraphs which are searched for keywords and analyzed
-                for sentiment. The results are uploaded to datastore and saved as a CSV.
+                for sentiment. The results are saved to 'output_file_path' in batches as paragraphs are
+                scored, and uploaded to datastore once the file is complete. Stage times and counters are recorded by
+                self.instrumentation and exported once the request is done. With a store, once the
+                request succeeds, its scored paragraphs replace any previously stored for the
+                transcript. If the request fails, its partial results file is deleted.
         '''
-        self.transcript_processor = TranscriptProcessor(transcript_file_path)
-        self.keyword_analyzer = KeywordAnalyzer(keywords_file_path)
-        self.data_manager = DataManager()
+        if output_file_path is None:
+            output_file_path = get_output_name(company, date)
+        instrumentation = self.instrumentation
+        instrumentation.start_request()
+        self.store_items = [] if self.store is not None else None
 
-        paragraphs = self.transcript_processor.get_paragraphs()
-        for paragraph in paragraphs:
-            self.process_paragraph(paragraph)
+        with instrumentation.stage('docx'):
+            self.transcript_processor = TranscriptProcessor(transcript_file_path, streaming=self.streaming)
+        with instrumentation.stage('keyword_file'):
+            self.keyword_analyzer = KeywordAnalyzer(keywords_file_path, self.word_boundaries)
+        upload_buffer = UploadBuffer() if self.upload_enabled else None
+        self.data_manager = DataManager(output_file_path, self.keyword_analyzer.get_fields(),
+                                        on_flush=upload_buffer.add if upload_buffer else None,
+                                        keywords=self.keyword_analyzer.keywords, layout=self.layout)
+
+        try:
+            # Collect keyword-matching paragraphs (every paragraph with score_all) so they can be
+            # scored in batches
+            matches = []
+            position = 0
+            paragraphs = self.transcript_processor.iter_paragraphs()
+            while True:
+                # When streaming, reading the docx happens here, one paragraph at a time
+                with instrumentation.stage('docx'):
+                    paragraph = next(paragraphs, None)
+                if paragraph is None:
+                    break
+                instrumentation.count('paragraphs_seen')
+                with instrumentation.stage('keywords'):
+                    keyword_ids = self.keyword_analyzer.find_keyword_ids(paragraph)
+                if keyword_ids or self.score_all:
+                    matches.append((paragraph, keyword_ids, position))
+                position += 1
+                if len(matches) >= self.chunk_size:
+                    self.process_matches(matches)
+                    matches = []
+            self.process_matches(matches)
 
-        for data in self.data_manager.get_data():
-            self.database.create_entity("Test", data)
+            with instrumentation.stage('write'):
+                self.data_manager.close()
+            if upload_buffer is not None:
+                self.upload(upload_buffer.rows, upload_buffer.get_paragraphs())
+        except BaseException:
+            # Workers are reused for other transcripts, so nothing is left open or half written
+            self.data_manager.discard()
+            raise
+        if self.store is not None:
+            with instrumentation.stage('write'):
+                self.store.replace_transcript(*get_store_labels(transcript_file_path, company, date),
+                                              self.sentiment_analyzer.model_id, self.store_items)
+        instrumentation.finish_request(transcript=transcript_file_path, output=output_file_path)
+        return output_file_path
 
-        self.data_manager.save_as_csv("test.csv")
+    def process_matches(self, matches):
+        '''
+            Args:
+                matches: list of (paragraph, keyword_ids, position) tuples, position being the
+                         paragraph's index in the transcript
+
+            Results:
+                Analyzes every paragraph in 'matches' for sentiment as a batch and saves the
+                results of those with keywords to the data manager (and every result to self.store_items)
+        '''
+        results = self.sentiment_analyzer.analyze_batch([paragraph for paragraph, _, _ in matches])
+        with self.instrumentation.stage('write'):
+            save_results(self.data_manager, self.keyword_analyzer, self.sentiment_analyzer, matches, results,
+                         self.store_items, self.instrumentation)
+
+    def upload(self, rows, paragraphs):
+        '''
+            Args:
+                rows:       list of dicts, one per keyword per paragraph, with a "ParagraphId"
+                            instead of the paragraph text
+                paragraphs: list of dicts, one per paragraph in 'rows' (see DataManager.get_paragraph_rows)
+
+            Results:
+                Uploads each paragraph once (keyed by its ID, so a paragraph already uploaded is
+                overwritten rather than duplicated) and 'rows' to datastore
+        '''
+        with self.instrumentation.stage('upload'):
+            uploaded = upload_results(self.database, rows, paragraphs)
+        self.instrumentation.count('entities_uploaded', uploaded)
+
+    @classmethod
+    def process_directory(cls, directory, keywords_file_path, output_directory=None, processes=None,
+                          threads_per_process=None, output_format='csv', **handler_kwargs):
+        '''
+            Args:
+                directory:              path to directory of transcripts (docx files), named like
+                                        CC_{company}_Q{quarter}{year}_{month}_{day}_{year}.docx
+                keywords_file_path:     file path containing keywords to be analyzed
+                output_directory:       directory for the CSVs (defaults to 'directory')
+                processes:              number of worker processes (defaults to the number of CPUs)
+                threads_per_process:    model intra-op threads per worker (defaults to CPUs / processes)
+                output_format:          'csv', 'parquet' or 'arrow'
+                handler_kwargs:         passed to Handler() in each worker (eg model_name, backend
+                                        or batch_size)
+
+            Returns:
+                List of dictionaries, one per transcript, with the 'Transcript' path, the 'Output'
+                results path (None on failure), and the 'Error' traceback (None on success)
+
+            Results:
+                Each transcript is processed with process_request() by a pool of worker processes.
+                Each worker builds a single Handler (loading the model once) and reuses it for
+                every transcript it is given. A failed transcript does not stop the others, even
+                if it kills its worker process (eg running out of memory), see run_jobs().
+        '''
+        if output_directory is None:
+            output_directory = directory
+        os.makedirs(output_directory, exist_ok=True)
+
+        filenames = [
+            filename for filename in sorted(os.listdir(directory))
+            if filename.endswith('.docx') and not filename.startswith('~$')
+        ]
+        transcripts = [(filename, *parse_transcript_name(filename)[::2]) for filename in filenames]
+        output_file_paths = get_output_paths(transcripts, output_directory, output_format)
+        jobs = [
+            (os.path.join(directory, filename), keywords_file_path, company, date, output_file_path)
+            for (filename, company, date), output_file_path in zip(transcripts, output_file_paths)
+        ]
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = max(1, min(processes, len(jobs)))
+        if threads_per_process is None:
+            threads_per_process = max(1, (os.cpu_count() or 1) // processes)
+
+        # ONNX models are exported here once, rather than by every worker at the same time
+        backend = get_backend(handler_kwargs.get('backend', 'torch'), handler_kwargs.get('model_name', 'ProsusAI/finBERT'))
+        if jobs and isinstance(backend, OnnxBackend):
+            backend.export()
+
+        # Prometheus files hold running totals for one process, so each worker needs its own
+        for exporter in getattr(handler_kwargs.get('instrumentation'), 'exporters', []):
+            if isinstance(exporter, PrometheusExporter):
+                exporter.per_process = processes > 1
+
+        if processes == 1:
+            init_worker(handler_kwargs, threads_per_process)
+            return [process_transcript(job) for job in jobs]
+
+        results = [None] * len(jobs)
+        indices = list(range(len(jobs)))
+        while indices:
+            finished, suspects = run_jobs(jobs, indices, processes, handler_kwargs, threads_per_process)
+            for index, result in finished.items():
+                results[index] = result
+            # Any transcript in progress when a worker died may have killed it, so each is run
+            # again on its own to find which did. The rest go to a new pool.
+            for index in suspects:
+                if len(suspects) > 1:
+                    finished, _ = run_jobs(jobs, [index], 1, handler_kwargs, threads_per_process)
+                    if index in finished:
+                        results[index] = finished[index]
+                        continue
+                results[index] = {
+                    'Transcript': jobs[index][0], 'Output': None,
+                    'Error': 'Worker process died while processing this transcript (eg killed for running out of memory)',
+                }
+            indices = [index for index in indices if results[index] is None]
+        return results
 
     def process_paragraph(self, paragraph):
         '''
@@ -69,38 +321,459 @@ class Handler:
                 the data manager containing the paragraph, score, magnitude, and information in 
                 the keyword entry.
         '''
-        found_keywords = self.keyword_analyzer.find_keywords(paragraph)
+        self.instrumentation.count('paragraphs_seen')
+        with self.instrumentation.stage('keywords'):
+            keyword_ids = self.keyword_analyzer.find_keyword_ids(paragraph)
         
-        if not found_keywords:
+        if not keyword_ids:
             return
 
         score, magnitude = self.sentiment_analyzer.analyze_sentiment(paragraph)
-        for entry in found_keywords:
-            weight = self.keyword_analyzer.get_weight(entry)
-            weighted_score = self.sentiment_analyzer.weight_sentiment(score.item(), weight)
+        with self.instrumentation.stage('write'):
+            self.add_results(paragraph, keyword_ids, score, magnitude)
+
+    def add_results(self, paragraph, keyword_ids, score, magnitude):
+        '''
+            Args:
+                paragraph:      a string of text that was analyzed for sentiment
+                keyword_ids:    indices (in self.keyword_analyzer.keywords) of keywords found in 'paragraph'
+                score:          sentiment score of 'paragraph'
+                magnitude:      sentiment magnitude of 'paragraph'
+
+            Results:
+                The paragraph, score and magnitude are saved to the data manager once, with the
+                ID and weighted score of each keyword
+        '''
+        save_results(self.data_manager, self.keyword_analyzer, self.sentiment_analyzer, [(paragraph, keyword_ids)],
+                     [(score, magnitude)], instrumentation=self.instrumentation)
+
+
+def save_results(data_manager, keyword_analyzer, sentiment_analyzer, matches, results, store_items=None,
+                 instrumentation=None):
+    '''
+        Args:
+            data_manager:       DataManager the results are saved to (and uploaded from, see upload_results)
+            keyword_analyzer:   KeywordAnalyzer that found the keywords
+            sentiment_analyzer: SentimentAnalyzer that scored the paragraphs
+            matches:            list of (paragraph, keyword_ids) or (paragraph, keyword_ids, position)
+                                tuples, position being the paragraph's index in the transcript
+            results:            (score, magnitude) of each paragraph in 'matches'
+            store_items:        list that (position, paragraph, score, magnitude) of every paragraph in
+                                'matches' is appended to (needs positions), for ParagraphStore.replace_transcript()
+            instrumentation:    Instrumentation counting matched paragraphs and keyword hits
+
+        Returns:
+            Number of paragraphs with keywords saved
+
+        Results:
+            Each paragraph with keywords is saved to 'data_manager' once, with the ID and weighted
+            score of each keyword. Used by Handler and service.ScoringService, so both save the same results.
+    '''
+    instrumentation = instrumentation or NullInstrumentation()
+    saved = 0
+    for (paragraph, keyword_ids, *_), (score, magnitude) in zip(matches, results):
+        if not keyword_ids:
+            continue
+        instrumentation.count('paragraphs_matched')
+        instrumentation.count('keyword_hits', len(keyword_ids))
+        data_manager.add_paragraph(
+            paragraph, score, magnitude, get_keyword_hits(keyword_analyzer, sentiment_analyzer, keyword_ids, score)
+        )
+        saved += 1
+    if store_items is not None:
+        store_items.extend(
+            (position, paragraph, score, magnitude)
+            for (paragraph, _, position), (score, magnitude) in zip(matches, results)
+        )
+    return saved
+
+
+def upload_results(database, rows, paragraphs):
+    '''
+        Args:
+            database:   Database to upload to
+            rows:       list of dicts, one per keyword per paragraph, with a "ParagraphId"
+                        instead of the paragraph text
+            paragraphs: list of dicts, one per paragraph in 'rows' (see DataManager.get_paragraph_rows)
+
+        Returns:
+            Number of entities uploaded
+
+        Results:
+            Uploads each paragraph once under "Paragraph" (keyed by its ID, so a paragraph already
+            uploaded is overwritten rather than duplicated) and 'rows' under "Test". If uploading
+            'rows' fails, those already uploaded are deleted, so a retry doesn't duplicate them.
+    '''
+    uploaded = database.create_entities("Paragraph", paragraphs, key_field='ParagraphId', exclude_from_indexes=('Paragraph',))
+    uploaded += database.create_entities("Test", rows, rollback=True)
+    return uploaded
+
+
+# Collects the rows a DataManager flushes (as its on_flush), so they are only uploaded once the
+# whole transcript has been saved, and a failed transcript uploads nothing
+class UploadBuffer:
+    def __init__(self):
+        self.rows = []
+        self.paragraphs = {}
+
+    def add(self, rows, paragraphs):
+        ''' Keeps 'rows' and 'paragraphs' (see upload_results), each distinct paragraph once '''
+        self.rows.extend(rows)
+        for paragraph in paragraphs:
+            self.paragraphs.setdefault(paragraph['ParagraphId'], paragraph)
+
+    def get_paragraphs(self):
+        ''' Returns the list of distinct paragraphs added '''
+        return list(self.paragraphs.values())
+
+
+def get_store_labels(transcript_file_path, company=None, date=None):
+    '''
+        Returns:
+            (transcript, company, period, date) that paragraphs of the transcript are stored under
+            in a ParagraphStore, transcript being its absolute path (so transcripts with the same
+            name in different directories are kept apart). Company and date default to those in its name.
+    '''
+    name_company, period, name_date = parse_transcript_name(transcript_file_path)
+    return os.path.abspath(transcript_file_path), company or name_company, period, date or name_date
+
+
+def get_keyword_hits(keyword_analyzer, sentiment_analyzer, keyword_ids, score):
+    '''
+        Args:
+            keyword_analyzer:   KeywordAnalyzer that found the keywords
+            sentiment_analyzer: SentimentAnalyzer that scored the paragraph
+            keyword_ids:        indices (in keyword_analyzer.keywords) of keywords found in a paragraph
+            score:              sentiment score of the paragraph
+
+        Returns:
+            List of (keyword_id, weighted_score) for DataManager.add_paragraph()
+    '''
+    hits = []
+    for keyword_id in keyword_ids:
+        weight = keyword_analyzer.get_weight(keyword_analyzer.keywords[keyword_id])
+        hits.append((keyword_id, sentiment_analyzer.weight_sentiment(score, weight)))
+    return hits
+
+
+# Handler used by the current worker process in Handler.process_directory()
+# If building it failed, worker_error holds the traceback instead
+worker_handler = None
+worker_error = None
+
+
+def init_worker(handler_kwargs, threads):
+    '''
+        Args:
+            handler_kwargs: passed to Handler()
+            threads:        number of model intra-op threads for this process
+
+        Results:
+            Builds the Handler (and model) for this worker process, limited to 'threads' model
+            threads (torch or ONNX Runtime, see get_backend)
+            Errors are saved rather than raised, since a failing pool initializer breaks the pool
+    '''
+    global worker_handler, worker_error
+    try:
+        worker_handler = Handler(**handler_kwargs, threads=threads)
+    except Exception:
+        worker_error = traceback.format_exc()
+
+
+def run_jobs(jobs, indices, processes, handler_kwargs, threads):
+    '''
+        Args:
+            jobs:           list of jobs for process_transcript()
+            indices:        indices (in 'jobs') of the jobs to run
+            processes:      number of worker processes
+            handler_kwargs: passed to Handler() in each worker
+            threads:        number of model intra-op threads per worker
+
+        Returns:
+            Tuple of (dictionary of results of finished jobs by index, list of indices of the jobs
+            in progress if a worker process died, which breaks the pool). Jobs not started before
+            the pool broke are in neither.
+
+        Results:
+            Runs jobs in a new pool of worker processes (see init_worker), at most one per worker
+            at a time, so the jobs in progress when a worker dies are known
+    '''
+    context = multiprocessing.get_context('spawn')
+    executor = ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker, initargs=(handler_kwargs, threads))
+    waiting = iter(indices)
+    running = {}
+    finished = {}
+    suspects = []
+    try:
+        for index in waiting:
+            running[executor.submit(process_transcript, jobs[index])] = index
+            if len(running) >= processes:
+                break
+        while running and not suspects:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    finished[index] = future.result()
+                except BrokenProcessPool:
+                    suspects.append(index)
+            if suspects:
+                suspects.extend(running.values())
+                break
+            for index in waiting:
+                running[executor.submit(process_transcript, jobs[index])] = index
+                if len(running) >= processes:
+                    break
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return finished, suspects
+
+
+def process_transcript(job):
+    '''
+        Args:
+            job: tuple of (transcript_file_path, keywords_file_path, company, date, output_file_path)
+
+        Returns:
+            Dictionary with the 'Transcript' path, 'Output' path, and 'Error' (traceback or None)
+    '''
+    transcript_file_path = job[0]
+    if worker_handler is None:
+        return {'Transcript': transcript_file_path, 'Output': None, 'Error': worker_error}
+    try:
+        output_file_path = worker_handler.process_request(*job)
+        return {'Transcript': transcript_file_path, 'Output': output_file_path, 'Error': None}
+    except Exception:
+        return {'Transcript': transcript_file_path, 'Output': None, 'Error': traceback.format_exc()}
+
+
+def parse_transcript_name(file_path):
+    '''
+        Args:
+            file_path: transcript file path, named like CC_{company}_Q{quarter}{year}_{month}_{day}_{year}
+
+        Returns:
+            Tuple of (company, period, date), eg ('WM US', 'Q42022', '2022-10-26')
+            If the name doesn't match, company is the file name (without extension) and
+            period and date are None
+    '''
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    match = re.search(r'CC_(.+)_Q(\d{1})(\d{4})_(\d{1,2})_(\d{1,2})_(\d{4})', name)
+    if not match:
+        return name, None, None
+    company, quarter, year, month, day, date_year = match.groups()
+    return company, f'Q{quarter}{year}', f'{date_year}-{int(month):02d}-{int(day):02d}'
+
+
+def get_output_name(company, date, output_format='csv'):
+    '''
+        Returns:
+            Results file name for a transcript from 'company' on 'date', eg 'WM US_2022-10-26.csv'
+    '''
+    parts = [str(part) for part in (company, date) if part]
+    return ('_'.join(parts) if parts else 'results') + '.' + output_format
+
+
+def get_output_paths(transcripts, output_directory, output_format='csv'):
+    '''
+        Args:
+            transcripts:        list of (transcript file path or name, company, date)
+            output_directory:   directory for the results
+            output_format:      'csv', 'parquet' or 'arrow'
+
+        Returns:
+            Results file path for each transcript, named by get_output_name(). Transcripts whose
+            company and date match an earlier one (eg a re-delivered '... (1).docx', or two calls
+            on the same day) are named after the transcript file instead, so no two share a file.
+    '''
+    output_file_paths = []
+    used = set()
+    for transcript_file_path, company, date in transcripts:
+        output_name = get_output_name(company, date, output_format)
+        if output_name.lower() in used:
+            output_name = os.path.splitext(os.path.basename(transcript_file_path))[0] + '.' + output_format
+        used.add(output_name.lower())
+        output_file_paths.append(os.path.join(output_directory, output_name))
+    return output_file_paths
+
+
+# Records wall and CPU time per pipeline stage, and counters (paragraphs, keyword hits, tokens,
+# uploads), for each request. Stage times exclude time spent in stages nested inside them
+# (eg uploads made while writing), so the stages of a request add up to its total time.
+# Summaries are passed to each exporter (see JsonExporter, PrometheusExporter) per request.
+class Instrumentation:
+    def __init__(self, exporters=None):
+        '''
+            Args:
+                exporters: list of objects with an export(summary, totals) method
+        '''
+        self.exporters = exporters or []
+        self.totals = {'requests': 0, 'stages': {}, 'counters': {}}
+        self.start_request()
+
+    def start_request(self):
+        ''' Clears the stages and counters of the current request and starts its timer '''
+        self.stages = {}
+        self.counters = {}
+        self.stack = []
+        self.request_start = (time.perf_counter(), time.process_time())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+            Args:
+                name: name of the stage, eg 'docx', 'keywords', 'finbert', 'vader', 'write', 'upload'
+
+            Results:
+                Adds the wall and CPU time of the with block (less any nested stages) to stage 'name'
+        '''
+        frame = [time.perf_counter(), time.process_time(), 0.0, 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            wall = time.perf_counter() - frame[0]
+            cpu = time.process_time() - frame[1]
+            if self.stack:
+                self.stack[-1][2] += wall
+                self.stack[-1][3] += cpu
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+            stage[0] += wall - frame[2]
+            stage[1] += cpu - frame[3]
+            stage[2] += 1
+
+    def count(self, name, value=1):
+        ''' Adds 'value' to counter 'name' '''
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_summary(self, **labels):
+        '''
+            Args:
+                labels: extra fields for the summary, eg the transcript path
+
+            Returns:
+                Dictionary of the current request's total wall and CPU time, per stage wall time,
+                CPU time and calls, and counters
+        '''
+        return {
+            **labels,
+            'wall_seconds': time.perf_counter() - self.request_start[0],
+            'cpu_seconds': time.process_time() - self.request_start[1],
+            'stages': {
+                name: {'wall_seconds': wall, 'cpu_seconds': cpu, 'calls': calls}
+                for name, (wall, cpu, calls) in self.stages.items()
+            },
+            'counters': dict(self.counters),
+        }
+
+    def finish_request(self, **labels):
+        '''
+            Args:
+                labels: extra fields for the summary, eg the transcript path
+
+            Returns:
+                Summary of the current request (see get_summary), after adding it to self.totals
+                and passing it to every exporter
+        '''
+        summary = self.get_summary(**labels)
+        self.totals['requests'] += 1
+        for name, stage in summary['stages'].items():
+            total = self.totals['stages'].setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+            for key in total:
+                total[key] += stage[key]
+        for name, value in summary['counters'].items():
+            self.totals['counters'][name] = self.totals['counters'].get(name, 0) + value
+        for exporter in self.exporters:
+            exporter.export(summary, self.totals)
+        return summary
+
+
+# Stands in for Instrumentation when it is disabled, doing nothing
+class NullInstrumentation:
+    null_stage = contextlib.nullcontext()
+
+    def start_request(self):
+        pass
 
-            self.data_manager.add_data(
-                Paragraph = paragraph,
-                Score = score.item(),
-                Magnitude = magnitude,
-                WeightedScore = weighted_score,
-                **entry
-            )
+    def stage(self, name):
+        return self.null_stage
+
+    def count(self, name, value=1):
+        pass
+
+    def finish_request(self, **labels):
+        return None
+
+
+# Appends each request summary to a JSON lines file
+class JsonExporter:
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def export(self, summary, totals):
+        with open(self.file_path, mode='a') as file:
+            file.write(json.dumps(summary) + '\n')
+
+
+# Writes the totals over every request so far in the Prometheus text format, eg for the
+# node_exporter textfile collector. '{pid}' in the file path is replaced by the process id,
+# so worker processes each write their own file. With per_process (set by
+# Handler.process_directory for more than one worker), the process id is added to a path
+# without '{pid}', eg metrics.prom -> metrics.{pid}.prom
+class PrometheusExporter:
+    def __init__(self, file_path, prefix='sentiment', per_process=False):
+        self.file_path = file_path
+        self.prefix = prefix
+        self.per_process = per_process
+
+    def get_file_path(self):
+        ''' Returns the file path for this process '''
+        file_path = self.file_path
+        if self.per_process and '{pid}' not in file_path:
+            stem, extension = os.path.splitext(file_path)
+            file_path = stem + '.{pid}' + extension
+        return file_path.replace('{pid}', str(os.getpid()))
+
+    def export(self, summary, totals):
+        lines = [
+            f'# TYPE {self.prefix}_requests_total counter',
+            f'{self.prefix}_requests_total {totals["requests"]}',
+        ]
+        for key in ('wall_seconds', 'cpu_seconds', 'calls'):
+            lines.append(f'# TYPE {self.prefix}_stage_{key}_total counter')
+            for name, stage in sorted(totals['stages'].items()):
+                lines.append(f'{self.prefix}_stage_{key}_total{{stage="{name}"}} {stage[key]}')
+        for name, value in sorted(totals['counters'].items()):
+            lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+            lines.append(f'{self.prefix}_{name}_total {value}')
+
+        # Replace the file in one step so a collector never reads a partial file
+        file_path = self.get_file_path()
+        with open(file_path + '.tmp', mode='w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(file_path + '.tmp', file_path)
 
 
 # Opens and parses transcript into paragraphs
-# Paragraphs are stored as list of strings
+# Paragraphs are stored as list of strings, or with streaming=True, read from the docx
+# XML as they are iterated (see iter_docx_paragraphs) without loading the document
 class TranscriptProcessor:
-    def __init__(self, file_path):
+    def __init__(self, file_path, streaming=False):
         self.file_path = file_path
-        self.document = self.read_document()
-        self.paragraphs = self.split_paragraphs()
+        self.streaming = streaming
+        self.document = None
+        self.paragraphs = None
+        if not streaming:
+            self.document = self.read_document()
+            self.paragraphs = self.split_paragraphs()
 
     def read_document(self):
         '''
             Returns:
                 The transcript at self.file_path (presumably a docx) as docx.Document object
         '''
+        import docx
         return docx.Document(self.file_path)
 
     def split_paragraphs(self):
@@ -117,15 +790,117 @@ class TranscriptProcessor:
         return paragraphs
 
     def get_paragraphs(self):
-        ''' Getter for self.paragraphs '''
+        ''' Getter for self.paragraphs (read from the file when streaming) '''
+        if self.streaming:
+            return list(self.iter_paragraphs())
         return self.paragraphs
 
+    def iter_paragraphs(self):
+        '''
+            Returns:
+                Iterator over the non-empty paragraphs, read from the file as they are
+                iterated when streaming
+        '''
+        if self.streaming:
+            return iter_docx_paragraphs(self.file_path)
+        return iter(self.paragraphs)
+
+
+# WordprocessingML namespace, and the text of run elements other than w:t and w:br
+# (as in python-docx)
+word_namespace = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+run_element_text = {
+    word_namespace + 'tab': '\t',
+    word_namespace + 'ptab': '\t',
+    word_namespace + 'cr': '\n',
+    word_namespace + 'noBreakHyphen': '-',
+}
+
+
+def get_docx_main_part(archive):
+    '''
+        Args:
+            archive: docx file as a zipfile.ZipFile
+
+        Returns:
+            Name of the main document part in 'archive' (usually 'word/document.xml')
+    '''
+    from lxml import etree
+    relationships = etree.fromstring(archive.read('_rels/.rels'))
+    for relationship in relationships:
+        if relationship.get('Type', '').endswith('/officeDocument'):
+            return relationship.get('Target').lstrip('/')
+    return 'word/document.xml'
+
+
+def get_paragraph_text(paragraph):
+    '''
+        Args:
+            paragraph: w:p element
+
+        Returns:
+            Text of 'paragraph', exactly as python-docx Paragraph.text: the text of its runs and
+            hyperlinked runs, with tabs as '\\t' and line breaks as '\\n'
+    '''
+    parts = []
+    for child in paragraph:
+        if child.tag == word_namespace + 'r':
+            runs = [child]
+        elif child.tag == word_namespace + 'hyperlink':
+            runs = child.iterchildren(word_namespace + 'r')
+        else:
+            continue
+        for run in runs:
+            for element in run:
+                if element.tag == word_namespace + 't':
+                    parts.append(element.text or '')
+                elif element.tag == word_namespace + 'br':
+                    # Page and column breaks have no text
+                    if element.get(word_namespace + 'type', 'textWrapping') == 'textWrapping':
+                        parts.append('\n')
+                elif element.tag in run_element_text:
+                    parts.append(run_element_text[element.tag])
+    return ''.join(parts)
+
+
+def iter_docx_paragraphs(file_path):
+    '''
+        Args:
+            file_path: docx file path
+
+        Returns:
+            Generator of the text of each non-empty paragraph in the document body (the same
+            paragraphs as TranscriptProcessor.split_paragraphs), parsed incrementally from the
+            document XML. Each paragraph is dropped from the tree once read, so memory stays
+            flat however large the document is.
+    '''
+    from lxml import etree
+    body = word_namespace + 'body'
+    with zipfile.ZipFile(file_path) as archive:
+        with archive.open(get_docx_main_part(archive)) as file:
+            # Same parser options as python-docx, so whitespace is handled the same way
+            events = etree.iterparse(file, events=('end',), tag=word_namespace + 'p',
+                                     remove_blank_text=True, resolve_entities=False)
+            for _, paragraph in events:
+                parent = paragraph.getparent()
+                # Paragraphs in tables etc. are not document paragraphs, and are dropped
+                # along with their table
+                if parent is None or parent.tag != body:
+                    continue
+                text = get_paragraph_text(paragraph)
+                paragraph.clear()
+                while paragraph.getprevious() is not None:
+                    del parent[0]
+                if text:
+                    yield text
+
 
 # Opens and saves keywords as list of dicts
 class KeywordAnalyzer:
-    def __init__(self, file_path):
+    def __init__(self, file_path, word_boundaries=False):
         self.file_path = file_path
         self.keywords = self.read_file()
+        self.matcher = KeywordMatcher([entry.get('Keyword') for entry in self.keywords], word_boundaries)
         self.importance_weights = { 'Very Important': 1.5,
                                     'Important': 1.0,
                                     'Less so important': 0.5 } 
@@ -135,8 +910,16 @@ class KeywordAnalyzer:
             Returns:
                 The keyword excel file at self.file_path as a list of dictionaries.
                 Example dictionary: {Keyword: 'Assets', Category: 'Financial Metric', ...}
+                The headers and their types are saved to self.fields
         '''
-        return pd.read_excel(self.file_path).to_dict('records')
+        import pandas as pd
+        keywords = pd.read_excel(self.file_path)
+        self.fields = [(column, get_field_type(dtype)) for column, dtype in keywords.dtypes.items()]
+        return keywords.to_dict('records')
+
+    def get_fields(self):
+        ''' Getter for self.fields, list of (header, type) of the keyword file '''
+        return self.fields
 
     def find_keywords(self, text):
         '''
@@ -146,13 +929,17 @@ class KeywordAnalyzer:
             Returns:
                 List of dictionaries for all keywords found in text.
         '''
-        found = []
-        text = text.lower()
-        for entry in self.keywords:
-            keyword = entry.get('Keyword')
-            if keyword.lower() in text:
-                found.append(entry)
-        return found
+        return [self.keywords[i] for i in self.matcher.find(text)]
+
+    def find_keyword_ids(self, text):
+        '''
+            Args:
+                text: string of text
+
+            Returns:
+                List of indices (in self.keywords) of all keywords found in text
+        '''
+        return self.matcher.find(text)
 
     def get_weight(self, entry):
         '''
@@ -169,12 +956,336 @@ class KeywordAnalyzer:
             return weight
 
 
+def get_field_type(dtype):
+    '''
+        Args:
+            dtype: pandas dtype of a keyword file column
+
+        Returns:
+            Type name for DataManager fields ('bool', 'int64', 'float64' or 'string')
+    '''
+    import pandas as pd
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'int64'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float64'
+    return 'string'
+
+
+# Aho-Corasick automaton over a list of keywords (case insensitive)
+# Finds every keyword in a text with a single pass over the text
+class KeywordMatcher:
+    def __init__(self, keywords, word_boundaries=False):
+        '''
+            Args:
+                keywords:           list of keyword strings (non-strings, eg blank cells, are ignored)
+                word_boundaries:    if True, keywords only match as whole words
+                                    (eg 'rate' does not match inside 'operate')
+        '''
+        self.word_boundaries = word_boundaries
+        self.patterns = []
+        # Trie of lowercased keywords: goto[state] maps a character to the next state
+        self.goto = [{}]
+        self.fail = [0]
+        # Keyword indices of patterns ending at each state (including those reached via fail links)
+        self.output = [[]]
+        for index, keyword in enumerate(keywords):
+            if isinstance(keyword, str) and keyword:
+                self.add_pattern(keyword.lower(), index)
+        self.build_fail_links()
+        self.lengths = {index: len(pattern) for index, pattern in self.patterns}
+
+    def add_pattern(self, pattern, index):
+        ''' Adds 'pattern' (for keyword at 'index') to the trie '''
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(index)
+        self.patterns.append((index, pattern))
+
+    def build_fail_links(self):
+        ''' Breadth first pass over the trie setting fail links and merging outputs '''
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def is_whole_word(self, text, start, end):
+        ''' Returns True if text[start:end] is not directly joined to other word characters '''
+        if start > 0 and text[start].isalnum() and text[start - 1].isalnum():
+            return False
+        if end < len(text) and text[end - 1].isalnum() and text[end].isalnum():
+            return False
+        return True
+
+    def find(self, text):
+        '''
+            Args:
+                text: string of text
+
+            Returns:
+                Sorted list of indices (into the keyword list) of every keyword found in 'text'
+        '''
+        found = set()
+        text = text.lower()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for index in self.output[state]:
+                if index in found:
+                    continue
+                if self.word_boundaries:
+                    start = position + 1 - self.lengths[index]
+                    if not self.is_whole_word(text, start, position + 1):
+                        continue
+                found.add(index)
+        return sorted(found)
+
+
+# Runs the sentiment model with PyTorch
+# Backends take padded numpy inputs from the tokenizer and return numpy probabilities
+class TorchBackend:
+    name = 'torch'
+
+    def __init__(self, model_name, threads=None):
+        self.model_name = model_name
+        self.threads = threads
+        self.model = None
+
+    def load(self):
+        ''' Loads the model (if it isn't already loaded), limiting torch to self.threads threads '''
+        if self.model is None:
+            if self.threads:
+                import torch
+                torch.set_num_threads(self.threads)
+            from transformers import AutoModelForSequenceClassification
+            self.model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+            self.model.eval()
+
+    def predict(self, inputs):
+        '''
+            Args:
+                inputs: dictionary of padded numpy arrays from the tokenizer (eg input_ids)
+
+            Returns:
+                numpy array of sentiment probabilities, one row per input
+        '''
+        import torch
+        from torch.nn.functional import softmax
+        self.load()
+        with torch.inference_mode():
+            outputs = self.model(**{key: torch.from_numpy(value) for key, value in inputs.items()})
+        return softmax(outputs.logits, dim=1).numpy()
+
+
+# Runs an ONNX export of the sentiment model with ONNX Runtime (needs onnxruntime)
+# The export (and optional int8 quantization) happens once, the first time the file is missing
+class OnnxBackend:
+    def __init__(self, model_name, file_path=None, quantize=False, threads=None):
+        self.model_name = model_name
+        self.quantize = quantize
+        self.threads = threads
+        self.name = 'onnx-int8' if quantize else 'onnx'
+        if file_path is None:
+            file_path = os.path.join('onnx', re.sub(r'[^\w.-]', '_', model_name) + ('-int8' if quantize else '') + '.onnx')
+        self.file_path = file_path
+        self.session = None
+
+    def export(self):
+        ''' Exports the model to self.file_path if it isn't there yet '''
+        if not os.path.exists(self.file_path):
+            export_onnx(self.model_name, self.file_path, self.quantize)
+
+    def load(self):
+        '''
+            Results:
+                Exports the model if needed, and starts the ONNX Runtime session, with an
+                intra-op pool of self.threads threads (every CPU if None)
+        '''
+        if self.session is not None:
+            return
+        self.export()
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+            options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(self.file_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [session_input.name for session_input in self.session.get_inputs()]
+
+    def predict(self, inputs):
+        '''
+            Args:
+                inputs: dictionary of padded numpy arrays from the tokenizer (eg input_ids)
+
+            Returns:
+                numpy array of sentiment probabilities, one row per input
+        '''
+        import numpy as np
+        self.load()
+        feed = {name: inputs[name].astype(np.int64) for name in self.input_names}
+        logits = self.session.run(None, feed)[0]
+        exponents = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exponents / exponents.sum(axis=1, keepdims=True)
+
+
+def export_onnx(model_name, file_path, quantize=False):
+    '''
+        Args:
+            model_name: sentiment model name or path
+            file_path:  file path for the ONNX model
+            quantize:   if True, the exported model is dynamically quantized to int8
+
+        Results:
+            Exports the model to ONNX at 'file_path' (with dynamic batch and sequence sizes). The
+            model is written to a temporary file for this process and then moved into place, so
+            other processes never see (or remove) a partial export.
+    '''
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    if os.path.dirname(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.eval()
+    inputs = AutoTokenizer.from_pretrained(model_name)(['An example paragraph.'], return_tensors='pt')
+    # Inputs are passed positionally, in the order model.forward() takes them
+    input_names = [name for name in inspect.signature(model.forward).parameters if name in inputs]
+    temporary_path = f'{os.path.splitext(file_path)[0]}.{os.getpid()}.tmp.onnx'
+    export_path = temporary_path + '.fp32.onnx' if quantize else temporary_path
+    torch.onnx.export(
+        model, tuple(inputs[name] for name in input_names), export_path, dynamo=False,
+        input_names=input_names, output_names=['logits'], opset_version=17,
+        dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names}, 'logits': {0: 'batch'}}
+    )
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(export_path, temporary_path, weight_type=QuantType.QInt8)
+        os.remove(export_path)
+    os.replace(temporary_path, file_path)
+
+
+def get_backend(backend, model_name, onnx_file_path=None, threads=None):
+    '''
+        Args:
+            backend:        'torch', 'onnx' or 'onnx-int8'
+            model_name:     sentiment model name or path
+            onnx_file_path: file path of the ONNX model (ONNX backends only)
+            threads:        intra-op threads for the model (None for the backend's default)
+
+        Returns:
+            The backend object for 'backend'
+    '''
+    if backend == 'torch':
+        return TorchBackend(model_name, threads)
+    if backend in ('onnx', 'onnx-int8'):
+        return OnnxBackend(model_name, onnx_file_path, quantize=backend == 'onnx-int8', threads=threads)
+    raise ValueError(f'Unknown backend {backend}, expected torch, onnx or onnx-int8')
+
+
+def check_backend_parity(texts, reference, candidate):
+    '''
+        Args:
+            texts:      list of strings of text, presumably a sample of paragraphs
+            reference:  SentimentAnalyzer with the baseline backend (eg torch)
+            candidate:  SentimentAnalyzer with the backend to compare (eg onnx-int8)
+
+        Returns:
+            Dictionary of how far 'candidate' drifts from 'reference' on 'texts':
+            mean and max absolute difference in sentiment score and probabilities, and the
+            fraction of texts where both agree on the most likely label
+    '''
+    import numpy as np
+    reference_probabilities = np.array(reference.get_batch_probabilities(texts))
+    candidate_probabilities = np.array(candidate.get_batch_probabilities(texts))
+    score_differences = np.abs(
+        np.array([float(reference.get_score(probs)) for probs in reference_probabilities]) -
+        np.array([float(candidate.get_score(probs)) for probs in candidate_probabilities])
+    )
+    probability_differences = np.abs(reference_probabilities - candidate_probabilities)
+    return {
+        'Paragraphs': len(texts),
+        'Reference': reference.backend.name,
+        'Candidate': candidate.backend.name,
+        'Mean Score Difference': float(score_differences.mean()),
+        'Max Score Difference': float(score_differences.max()),
+        'Max Probability Difference': float(probability_differences.max()),
+        'Label Agreement': float((reference_probabilities.argmax(axis=1) == candidate_probabilities.argmax(axis=1)).mean()),
+    }
+
+
 # Analyzes sentiment of text (does not store any data)
+# The model, tokenizer and VADER analyzer are loaded on first use
+# The model is run by a backend (see get_backend()), chosen by 'backend'
+# In cascade mode (a cascade_threshold is given), paragraphs whose VADER score is confident
+# enough are scored from VADER alone (see get_cheap_score), and only the rest by the model
+# In windowed mode, paragraphs longer than the model's limit are scored in full from
+# overlapping windows (see get_windowed_probabilities) rather than truncated
 class SentimentAnalyzer:
-    def __init__(self):
-        self.model = AutoModelForSequenceClassification.from_pretrained('ProsusAI/finBERT')
-        self.tokenizer = AutoTokenizer.from_pretrained('ProsusAI/finBERT')
-        self.sia = SentimentIntensityAnalyzer()
+    def __init__(self, model_name='ProsusAI/finBERT', batch_size=16, cache=None, backend='torch', onnx_file_path=None,
+                 cascade_threshold=None, cascade_calibration=(1.0, 0.0), windowed=False, window_overlap=128,
+                 max_batch_tokens=4096, threads=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache = cache
+        self.backend = get_backend(backend, model_name, onnx_file_path, threads)
+        # Results differ (slightly) between backends, so they are cached separately
+        self.model_id = model_name if backend == 'torch' else f'{model_name}:{backend}'
+        # Windowed mode: tokens shared by consecutive windows, and the most (padded) tokens per
+        # forward pass, which replaces batch_size
+        self.windowed = windowed
+        self.window_overlap = window_overlap
+        self.max_batch_tokens = max_batch_tokens
+        if windowed:
+            self.model_id += f':windowed:{window_overlap}'
+        # Smallest absolute mean VADER compound score for which a paragraph isn't run through
+        # the model (None scores every paragraph with the model), and the (slope, intercept)
+        # mapping that mean compound score to a sentiment score (see check_cascade)
+        self.cascade_threshold = cascade_threshold
+        self.cascade_calibration = tuple(cascade_calibration)
+        if cascade_threshold is not None:
+            self.model_id += ':cascade:{}:{}:{}'.format(cascade_threshold, *self.cascade_calibration)
+        # Number of paragraphs scored in cascade mode, and how many of those needed the model
+        self.cascade_stats = {'paragraphs': 0, 'escalated': 0}
+        self._tokenizer = None
+        self._sia = None
+        # VADER compound score of sentences already scored (cleared once it holds
+        # max_cached_sentences), so repeated sentences are only scored once
+        self.sentence_compounds = {}
+        self.max_cached_sentences = 100000
+        # Records model and VADER time and tokens (set by Handler)
+        self.instrumentation = NullInstrumentation()
+
+    @property
+    def tokenizer(self):
+        ''' Tokenizer for self.model_name, loaded on first use '''
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        return self._tokenizer
+
+    @property
+    def sia(self):
+        ''' VADER SentimentIntensityAnalyzer, loaded on first use '''
+        if self._sia is None:
+            ensure_nltk_data()
+            from nltk.sentiment import SentimentIntensityAnalyzer
+            self._sia = SentimentIntensityAnalyzer()
+        return self._sia
 
     def get_probabilities(self, text):
         '''
@@ -185,10 +1296,178 @@ class SentimentAnalyzer:
                 Sentiment probabilities of 'text'
                 Appears to be a list of [positive, negative, neutral] sentiment values between 0 and 1
         '''
-        inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
-        outputs = self.model(**inputs)
-        probabilities = softmax(outputs.logits, dim=1)
-        return probabilities[0]
+        if self.windowed:
+            return self.get_windowed_probabilities([text])[0]
+        inputs = self.tokenizer(text, return_tensors="np", padding=True, truncation=True)
+        self.instrumentation.count('tokens', inputs['input_ids'].size)
+        return self.backend.predict(dict(inputs))[0]
+
+    def get_batch_probabilities(self, texts):
+        '''
+            Args:
+                texts: list of strings of text
+
+            Returns:
+                List of sentiment probabilities, one per string in 'texts' (same order)
+                Texts are sorted by token length and padded per batch of self.batch_size,
+                so each forward pass only pads to the longest text in its own batch
+        '''
+        if not texts:
+            return []
+        if self.windowed:
+            return self.get_windowed_probabilities(texts)
+
+        encodings = self.tokenizer(texts, truncation=True)
+        self.instrumentation.count('tokens', sum(len(input_ids) for input_ids in encodings['input_ids']))
+        order = sorted(range(len(texts)), key=lambda i: len(encodings['input_ids'][i]))
+
+        probabilities = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            features = [{key: encodings[key][i] for key in encodings.keys()} for i in batch]
+            inputs = self.tokenizer.pad(features, return_tensors="np")
+            for i, row in zip(batch, self.backend.predict(dict(inputs))):
+                probabilities[i] = row
+        return probabilities
+
+    def get_windowed_probabilities(self, texts):
+        '''
+            Args:
+                texts: list of strings of text
+
+            Returns:
+                List of sentiment probabilities, one per string in 'texts' (same order)
+                Each text is split into windows of at most the model's maximum length, each
+                sharing self.window_overlap tokens with the previous one (a text that fits is a
+                single window, scored exactly as without windows). Windows of every text are
+                sorted by length and packed into batches of at most self.max_batch_tokens
+                padded tokens. A text's probabilities are the mean of its windows', weighted
+                by the number of tokens in each window. Windows come from the tokenizer's
+                overflowing tokens, which needs a fast tokenizer (as AutoTokenizer loads for finBERT).
+        '''
+        import numpy as np
+        tokenizer = self.tokenizer
+        encodings = tokenizer(
+            texts, truncation=True, max_length=min(tokenizer.model_max_length, 512),
+            stride=self.window_overlap, return_overflowing_tokens=True
+        )
+        special_tokens = tokenizer.num_special_tokens_to_add()
+        keys = [key for key in encodings.keys() if key != 'overflow_to_sample_mapping']
+
+        # (text index, token count, features) for every window
+        windows = []
+        for j, i in enumerate(encodings['overflow_to_sample_mapping']):
+            features = {key: encodings[key][j] for key in keys}
+            windows.append((i, len(features['input_ids']) - special_tokens, features))
+        self.instrumentation.count('tokens', sum(len(features['input_ids']) for _, _, features in windows))
+        windows.sort(key=lambda window: len(window[2]['input_ids']))
+
+        # Windows are sorted by length, so the last window added is the longest in its batch
+        batches = [[]]
+        for window in windows:
+            padded_tokens = (len(batches[-1]) + 1) * len(window[2]['input_ids'])
+            if batches[-1] and padded_tokens > self.max_batch_tokens:
+                batches.append([])
+            batches[-1].append(window)
+
+        # (probabilities, token count) of each window of each text
+        window_results = [[] for _ in texts]
+        for batch in batches:
+            inputs = tokenizer.pad([features for _, _, features in batch], return_tensors="np")
+            for (i, token_count, _), row in zip(batch, self.backend.predict(dict(inputs))):
+                window_results[i].append((row, token_count))
+
+        probabilities = []
+        for results in window_results:
+            if len(results) == 1:
+                probabilities.append(results[0][0])
+            else:
+                rows, token_counts = zip(*results)
+                probabilities.append(np.average(np.array(rows), axis=0, weights=token_counts))
+        return probabilities
+
+    def get_score(self, probabilities):
+        '''
+            Args:
+                probabilities: sentiment probabilities from get_probabilities()
+
+            Returns:
+                Sentiment score for 'probabilities'
+        '''
+        return (probabilities[1] + (probabilities[2] * 2) + (probabilities[0] * 3)) - 2
+
+    def get_magnitude(self, text):
+        '''
+            Args:
+                text: string of text, presumably a paragraph
+
+            Returns:
+                Sum of the absolute VADER compound scores of each sentence in 'text'
+        '''
+        return self.get_magnitudes([text])[0]
+
+    def get_magnitudes(self, texts):
+        '''
+            Args:
+                texts: list of strings of text, presumably paragraphs
+
+            Returns:
+                List of get_magnitude() results, one per string in 'texts'
+        '''
+        return [get_total_magnitude(compounds) for compounds in self.get_sentence_compounds(texts)]
+
+    def get_sentence_compounds(self, texts):
+        '''
+            Args:
+                texts: list of strings of text, presumably paragraphs
+
+            Returns:
+                List of the VADER compound scores of each sentence, one list per string in 'texts'
+                Texts are split into sentences once, and each distinct sentence is scored once.
+                Sentences without any word from the VADER lexicon score 0 and are skipped.
+        '''
+        ensure_nltk_data()
+        from nltk.tokenize import sent_tokenize
+        paragraph_sentences = [sent_tokenize(text) for text in texts]
+
+        if len(self.sentence_compounds) > self.max_cached_sentences:
+            self.sentence_compounds = {}
+        for sentences in paragraph_sentences:
+            for sentence in sentences:
+                if sentence not in self.sentence_compounds:
+                    self.sentence_compounds[sentence] = self.get_sentence_compound(sentence)
+        return [[self.sentence_compounds[sentence] for sentence in sentences] for sentences in paragraph_sentences]
+
+    def get_cheap_score(self, compounds):
+        '''
+            Args:
+                compounds: VADER compound scores of each sentence of a paragraph
+
+            Returns:
+                Tuple of (estimated sentiment score, confidence) of the paragraph, from the mean
+                compound score mapped by self.cascade_calibration (clipped to [-1, 1], the range
+                of get_score()), and the absolute mean compound score
+        '''
+        mean = sum(compounds) / len(compounds) if compounds else 0.0
+        slope, intercept = self.cascade_calibration
+        return max(-1.0, min(1.0, slope * mean + intercept)), abs(mean)
+
+    def get_sentence_compound(self, sentence):
+        '''
+            Args:
+                sentence: string of text, a single sentence
+
+            Returns:
+                VADER compound score of 'sentence'
+        '''
+        # VADER only gives a word a valence if its lowercase form is in the lexicon, and the
+        # words it looks up come from either splitting the sentence on whitespace or splitting
+        # it after removing punctuation. Without any lexicon words, the compound score is 0.
+        lexicon = self.sia.lexicon
+        words = sentence.split() + self.sia.constants.REGEX_REMOVE_PUNCTUATION.sub('', sentence).split()
+        if not any(word.lower() in lexicon for word in words):
+            return 0.0
+        return self.sia.polarity_scores(sentence)['compound']
 
     def analyze_sentiment(self, text):
         '''
@@ -196,22 +1475,74 @@ class SentimentAnalyzer:
                 text: string of text, presumably a paragraph
 
             Returns:
-                Tuple of (sentiment_score, total_magnitude)
+                Tuple of (sentiment_score, total_magnitude) as floats
                 sentiment_score: sentiment of 'text'
                 total_magnitude: magnitude of 'text' sentiment
+                Results are read from / saved to self.cache when there is one
         '''
-        probabilities = self.get_probabilities(text)
-        sentiment_score = (probabilities[1] + (probabilities[2] * 2) + (probabilities[0] * 3)) - 2
-        
-        sentences = sent_tokenize(text)
-        magnitudes = []
-        for sentence in sentences:
-            sentence_magnitude = abs(self.sia.polarity_scores(sentence)['compound'])
-            magnitudes.append(sentence_magnitude)
-        total_magnitude = sum(magnitudes)
-        
+        if self.cascade_threshold is not None:
+            return self.analyze_batch([text])[0]
+        if self.cache is not None:
+            cached = self.cache.get(self.model_id, text)
+            if cached is not None:
+                return cached
+
+        with self.instrumentation.stage('finbert'):
+            sentiment_score = float(self.get_score(self.get_probabilities(text)))
+        with self.instrumentation.stage('vader'):
+            total_magnitude = self.get_magnitude(text)
+        self.instrumentation.count('paragraphs_scored')
+
+        if self.cache is not None:
+            self.cache.put(self.model_id, text, (sentiment_score, total_magnitude))
         return sentiment_score, total_magnitude
 
+    def analyze_batch(self, texts):
+        '''
+            Args:
+                texts: list of strings of text, presumably paragraphs
+
+            Returns:
+                List of (sentiment_score, total_magnitude) tuples, one per string in 'texts',
+                matching the output of analyze_sentiment(). Only texts missing from
+                self.cache (if there is one), and in cascade mode without a confident
+                VADER score, are run through the model.
+        '''
+        results = [None] * len(texts)
+        if self.cache is not None:
+            with self.instrumentation.stage('cache'):
+                results = self.cache.get_many(self.model_id, texts)
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        with self.instrumentation.stage('vader'):
+            compounds = self.get_sentence_compounds([texts[i] for i in missing])
+        scores = [None] * len(missing)
+        escalated = list(range(len(missing)))
+        if self.cascade_threshold is not None:
+            escalated = []
+            for j, paragraph_compounds in enumerate(compounds):
+                estimate, confidence = self.get_cheap_score(paragraph_compounds)
+                if confidence >= self.cascade_threshold:
+                    scores[j] = estimate
+                else:
+                    escalated.append(j)
+            self.cascade_stats['paragraphs'] += len(missing)
+            self.cascade_stats['escalated'] += len(escalated)
+            self.instrumentation.count('paragraphs_escalated', len(escalated))
+
+        with self.instrumentation.stage('finbert'):
+            probabilities = self.get_batch_probabilities([texts[missing[j]] for j in escalated])
+        for j, probs in zip(escalated, probabilities):
+            scores[j] = float(self.get_score(probs))
+        self.instrumentation.count('paragraphs_scored', len(missing))
+        for i, score, paragraph_compounds in zip(missing, scores, compounds):
+            results[i] = (score, get_total_magnitude(paragraph_compounds))
+
+        if self.cache is not None and missing:
+            with self.instrumentation.stage('cache'):
+                self.cache.put_many(self.model_id, [(texts[i], results[i]) for i in missing])
+        return results
+
     def weight_sentiment(self, sentiment, weight):
         '''
             Args:
@@ -227,26 +1558,571 @@ class SentimentAnalyzer:
         return sentiment * weight
 
 
-# Stores (sentiment) data as list of dicts, one dict per keyword per paragraph
-# Each dict contains at least "Keyword", "Paragraph", "Magnitude", and "Score"
+def get_total_magnitude(compounds):
+    ''' Returns the sum of the absolute VADER compound scores 'compounds' (in sentence order) '''
+    return sum([abs(compound) for compound in compounds])
+
+
+def get_score_label(score, neutral_band=0.2):
+    ''' Returns 'positive', 'negative' or 'neutral' for a sentiment score in [-1, 1] '''
+    if score > neutral_band:
+        return 'positive'
+    if score < -neutral_band:
+        return 'negative'
+    return 'neutral'
+
+
+def check_cascade(texts, sentiment_analyzer, thresholds=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7), neutral_band=0.2):
+    '''
+        Args:
+            texts:              list of strings of text, presumably a sample of paragraphs
+            sentiment_analyzer: SentimentAnalyzer (not in cascade mode) with the model to compare against
+            thresholds:         cascade thresholds to report on
+            neutral_band:       scores within +/- neutral_band are labelled neutral (see get_score_label)
+
+        Returns:
+            Dictionary with the 'Calibration' (slope, intercept) fitted from the mean VADER
+            compound score to the model's score on 'texts' (to pass as cascade_calibration),
+            the seconds taken by the model and by VADER, and for each threshold: the fraction of
+            paragraphs escalated to the model, the mean and max absolute difference from the
+            model's scores, the fraction with the same label, and the estimated seconds taken
+    '''
+    import numpy as np
+    start = time.perf_counter()
+    model_scores = np.array([float(sentiment_analyzer.get_score(probs)) for probs in sentiment_analyzer.get_batch_probabilities(texts)])
+    model_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compounds = sentiment_analyzer.get_sentence_compounds(texts)
+    vader_seconds = time.perf_counter() - start
+
+    means = np.array([sum(paragraph_compounds) / len(paragraph_compounds) if paragraph_compounds else 0.0 for paragraph_compounds in compounds])
+    slope, intercept = np.polyfit(means, model_scores, 1) if np.ptp(means) > 0 else (0.0, float(model_scores.mean()))
+    estimates = np.clip(slope * means + intercept, -1, 1)
+    model_labels = [get_score_label(score, neutral_band) for score in model_scores]
+
+    report = {
+        'Paragraphs': len(texts),
+        'Calibration': [float(slope), float(intercept)],
+        'Model Seconds': model_seconds,
+        'VADER Seconds': vader_seconds,
+        'Thresholds': [],
+    }
+    for threshold in thresholds:
+        escalated = np.abs(means) < threshold
+        scores = np.where(escalated, model_scores, estimates)
+        differences = np.abs(scores - model_scores)
+        labels = [get_score_label(score, neutral_band) for score in scores]
+        report['Thresholds'].append({
+            'Threshold': threshold,
+            'Escalation Rate': float(escalated.mean()),
+            'Mean Score Difference': float(differences.mean()),
+            'Max Score Difference': float(differences.max()),
+            'Label Agreement': float(np.mean([a == b for a, b in zip(labels, model_labels)])),
+            'Estimated Seconds': vader_seconds + float(escalated.mean()) * model_seconds,
+        })
+    return report
+
+
+# On-disk (sqlite) cache of analyze_sentiment() results, keyed by a hash of the
+# whitespace-normalized paragraph text and the model name
+# Least recently used entries are evicted once there are more than max_entries
+class SentimentCache:
+    def __init__(self, file_path, max_entries=1000000):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Worker processes share the file, so writers wait for each other's locks
+        self.connection = sqlite3.connect(file_path, timeout=60, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results '
+            '(key TEXT PRIMARY KEY, score REAL, magnitude REAL, last_used INTEGER)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.connection.commit()
+
+    def make_key(self, model_name, text):
+        '''
+            Args:
+                model_name: name of the model that produced the result
+                text:       string of text, presumably a paragraph
+
+            Returns:
+                Hex digest identifying 'text' (ignoring differences in whitespace) under 'model_name'
+        '''
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f'{model_name}\0{normalized}'.encode('utf-8')).hexdigest()
+
+    def get(self, model_name, text):
+        '''
+            Returns:
+                The cached (sentiment_score, total_magnitude) for 'text', or None if not cached
+        '''
+        return self.get_many(model_name, [text])[0]
+
+    def get_many(self, model_name, texts):
+        '''
+            Args:
+                model_name: name of the model that produced the results
+                texts:      list of strings of text, presumably paragraphs
+
+            Returns:
+                List of the cached (sentiment_score, total_magnitude) for each string in 'texts'
+                (None if not cached). Results are read, and marked as used, in one transaction.
+        '''
+        keys = [self.make_key(model_name, text) for text in texts]
+        found = {}
+        with self.lock:
+            # Queries are split to stay within sqlite's limit on parameters
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self.connection.execute(
+                    f'SELECT key, score, magnitude FROM results WHERE key IN ({", ".join("?" * len(chunk))})', chunk
+                ).fetchall()
+                found.update((key, (score, magnitude)) for key, score, magnitude in rows)
+            if found:
+                now = time.time_ns()
+                self.connection.executemany('UPDATE results SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+                self.connection.commit()
+            results = [found.get(key) for key in keys]
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put(self, model_name, text, result):
+        ''' Saves 'result', a (sentiment_score, total_magnitude) tuple, for 'text' '''
+        self.put_many(model_name, [(text, result)])
+
+    def put_many(self, model_name, items):
+        '''
+            Args:
+                model_name: name of the model that produced the results
+                items:      list of (text, (sentiment_score, total_magnitude)) tuples
+
+            Results:
+                Saves every result in 'items', then evicts least recently used entries
+                beyond self.max_entries
+        '''
+        now = time.time_ns()
+        rows = [(self.make_key(model_name, text), score, magnitude, now) for text, (score, magnitude) in items]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', rows)
+            count = self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+            self.connection.commit()
+
+    def get_stats(self):
+        ''' Returns dictionary of cache hits, misses, and number of stored entries '''
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+
+# On-disk (sqlite) store of scored paragraphs, with the transcript, company, period and date
+# they came from, indexed by company and period. Keyword files and weights can be applied
+# to the stored paragraphs again without the model (see rejoin)
+class ParagraphStore:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        # Worker processes share the file, so writers wait for each other's locks
+        self.connection = sqlite3.connect(file_path, timeout=60, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS paragraphs '
+            '(transcript TEXT, position INTEGER, paragraph_id TEXT, text TEXT, score REAL, magnitude REAL, '
+            'company TEXT, period TEXT, date TEXT, model TEXT, PRIMARY KEY (transcript, position))'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS paragraphs_company_period ON paragraphs (company, period)')
+        self.connection.commit()
+
+    def replace_transcript(self, transcript, company, period, date, model_name, items):
+        '''
+            Args:
+                transcript: transcript file path (see get_store_labels)
+                company:    Ticker of company for transcript
+                period:     quarter of transcript, in QxYYYY format
+                date:       date of transcript
+                model_name: ID of the model that scored the paragraphs (SentimentAnalyzer.model_id)
+                items:      list of (position, text, score, magnitude) tuples, position being the
+                            paragraph's index in the transcript
+
+            Results:
+                Replaces every paragraph stored for 'transcript' with those in 'items', in a single
+                transaction (so readers see either the old or the new paragraphs)
+        '''
+        rows = [
+            (transcript, position, get_paragraph_id(text), text, score, magnitude, company, period, date, model_name)
+            for position, text, score, magnitude in items
+        ]
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM paragraphs WHERE transcript = ?', (transcript,))
+            self.connection.executemany('INSERT INTO paragraphs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def iter_transcripts(self, companies=None, periods=None):
+        '''
+            Args:
+                companies:  only include these companies (None for all)
+                periods:    only include these periods, in QxYYYY format (None for all)
+
+            Returns:
+                Generator of (transcript, company, period, date, paragraphs) for every stored
+                transcript, paragraphs being a list of (paragraph_id, text, score, magnitude)
+                in transcript order
+        '''
+        query = 'SELECT transcript, company, period, date, paragraph_id, text, score, magnitude FROM paragraphs'
+        conditions, parameters = [], []
+        for column, values in (('company', companies), ('period', periods)):
+            if values:
+                conditions.append(f'{column} IN ({", ".join("?" * len(values))})')
+                parameters.extend(values)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY transcript, position'
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        current, paragraphs = None, []
+        for transcript, company, period, date, *paragraph in rows:
+            if current is not None and transcript != current[0]:
+                yield (*current, paragraphs)
+                paragraphs = []
+            current = (transcript, company, period, date)
+            paragraphs.append(tuple(paragraph))
+        if current is not None:
+            yield (*current, paragraphs)
+
+    def get_stats(self):
+        ''' Returns dictionary of the number of stored paragraphs and transcripts '''
+        with self.lock:
+            paragraphs, transcripts = self.connection.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT transcript) FROM paragraphs'
+            ).fetchone()
+        return {'paragraphs': paragraphs, 'transcripts': transcripts}
+
+
+def rejoin(store_file_path, keywords_file_path, output_directory, output_format='csv', layout='flat',
+           companies=None, periods=None, sentiment_analyzer=None, word_boundaries=False):
+    '''
+        Args:
+            store_file_path:    file path of a ParagraphStore filled by Handler(store_file_path=...)
+            keywords_file_path: file path containing keywords to be analyzed
+            output_directory:   directory for the results
+            output_format:      'csv', 'parquet' or 'arrow'
+            layout:             'flat' or 'normalized' (see DataManager)
+            companies:          only rejoin these companies (None for all)
+            periods:            only rejoin these periods, in QxYYYY format (None for all)
+            sentiment_analyzer: SentimentAnalyzer whose weight_sentiment() weights the scores
+                                (its model is never loaded)
+            word_boundaries:    if True, keywords only match as whole words (see KeywordMatcher)
+
+        Returns:
+            List of file paths of the saved results, one per stored transcript
+
+        Results:
+            The stored paragraphs of each transcript are searched for the keywords, and their
+            stored scores weighted again, saving results like Handler.process_request() without
+            running the model. Only stored paragraphs can match, ie those that matched the
+            keywords they were processed with, or every paragraph with Handler(score_all=True).
+    '''
+    keyword_analyzer = KeywordAnalyzer(keywords_file_path, word_boundaries)
+    if sentiment_analyzer is None:
+        sentiment_analyzer = SentimentAnalyzer()
+    store = ParagraphStore(store_file_path)
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Keywords found in each distinct paragraph, since transcripts repeat boilerplate
+    found = {}
+    transcripts = list(store.iter_transcripts(companies, periods))
+    output_file_paths = get_output_paths(
+        [(transcript, company, date) for transcript, company, _, date, _ in transcripts], output_directory, output_format
+    )
+    for (_, company, _, date, paragraphs), output_file_path in zip(transcripts, output_file_paths):
+        data_manager = DataManager(output_file_path, keyword_analyzer.get_fields(),
+                                   keywords=keyword_analyzer.keywords, layout=layout)
+        for paragraph_id, text, _, _ in paragraphs:
+            if paragraph_id not in found:
+                found[paragraph_id] = keyword_analyzer.find_keyword_ids(text)
+        save_results(data_manager, keyword_analyzer, sentiment_analyzer,
+                     [(text, found[paragraph_id]) for paragraph_id, text, _, _ in paragraphs],
+                     [(score, magnitude) for _, _, score, magnitude in paragraphs])
+        data_manager.close()
+    return output_file_paths
+
+
+# A paragraph that matched keywords, stored once however many keywords it matched
+class ParagraphRecord:
+    __slots__ = ('id', 'text', 'score', 'magnitude')
+
+    def __init__(self, text, score, magnitude):
+        self.id = get_paragraph_id(text)
+        self.text = text
+        self.score = score
+        self.magnitude = magnitude
+
+
+# A keyword found in a paragraph, referencing the paragraph record and the keyword's index
+# in the keyword file (DataManager.keywords)
+class KeywordHit:
+    __slots__ = ('paragraph', 'keyword_id', 'weighted_score')
+
+    def __init__(self, paragraph, keyword_id, weighted_score):
+        self.paragraph = paragraph
+        self.keyword_id = keyword_id
+        self.weighted_score = weighted_score
+
+
+def get_paragraph_id(text):
+    ''' Returns the ID of a paragraph, a hash of its text (so the same text always has the same ID) '''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+# Stores (sentiment) data as paragraph records and keyword hits referencing them (see
+# add_paragraph), so a paragraph's text is stored once however many keywords it matched.
+# Rows (one dict per keyword per paragraph, containing at least "Keyword", "Paragraph",
+# "Magnitude", and "Score") are only built when data is exported (see get_rows).
+# Without a target file, data is kept in memory
+# With a target file, data is streamed: every 'batch_size' rows are written to the file
+# (CSV, Parquet or Arrow IPC, by extension), passed to 'on_flush', and dropped from memory
+# With layout='normalized', rows are written with a "ParagraphId" instead of the paragraph
+# text, and each paragraph is written once to a second file ({name}.paragraphs{extension})
 class DataManager:
-    def __init__(self):
+    # (name, type) of the fields added by Handler, keyword file fields follow these
+    result_fields = [('Paragraph', 'string'), ('Score', 'float64'), ('Magnitude', 'float64'), ('WeightedScore', 'float64')]
+    paragraph_fields = [('ParagraphId', 'string'), ('Paragraph', 'string'), ('Score', 'float64'), ('Magnitude', 'float64')]
+    file_formats = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+    layouts = ('flat', 'normalized')
+
+    def __init__(self, target_file_path=None, fields=None, batch_size=1000, on_flush=None, keywords=None, layout='flat'):
+        '''
+            Args:
+                target_file_path:   file path to stream data to (None keeps data in memory)
+                fields:             list of (name, type) for keyword file fields, eg from
+                                    KeywordAnalyzer.get_fields(). Types are 'string', 'float64',
+                                    'int64' or 'bool'
+                batch_size:         number of rows buffered before they are written
+                on_flush:           function called with each batch of rows as it is written (with
+                                    "ParagraphId" instead of the text), and the list of paragraph
+                                    rows they reference (see get_paragraph_rows)
+                keywords:           list of keyword entries that hits refer to by index, eg
+                                    KeywordAnalyzer.keywords
+                layout:             'flat' or 'normalized' (see above)
+        '''
+        if layout not in self.layouts:
+            raise ValueError(f'Unsupported layout {layout}, expected one of {list(self.layouts)}')
         self.data = []
+        self.paragraphs = []
+        self.hits = []
+        self.keywords = keywords or []
+        self.target_file_path = target_file_path
+        self.layout = layout
+        result_names = [name for name, _ in self.result_fields]
+        self.fields = self.result_fields + [field for field in fields or [] if field[0] not in result_names]
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.rows_written = 0
+        self.file = None
+        self.writer = None
+        self.paragraph_file = None
+        self.paragraph_writer = None
+        self.file_format = None
+        if target_file_path is not None:
+            extension = os.path.splitext(target_file_path)[1].lower()
+            if extension not in self.file_formats:
+                raise ValueError(f'Unsupported file type {extension}, expected one of {list(self.file_formats)}')
+            self.file_format = self.file_formats[extension]
 
     def add_data(self, **entry):
         '''
             Args:
-                kwargs: dictionary containing a paragraph, the keyword found in that found paragraph,
+                entry: dictionary containing a paragraph, the keyword found in that found paragraph,
                 the paragraph sentiment score, and related information
 
             Results:
-                Appends dictionary to self.data
+                Appends dictionary to self.data as a row as is, flushing once 'batch_size'
+                rows are buffered (streaming only). Prefer add_paragraph(), which doesn't
+                copy the paragraph for each keyword.
         '''
-        self.data.append(kwargs)
-    
+        self.data.append(entry)
+        self.flush_if_full()
+
+    def add_paragraph(self, text, score, magnitude, hits):
+        '''
+            Args:
+                text:       paragraph text
+                score:      sentiment score of the paragraph
+                magnitude:  sentiment magnitude of the paragraph
+                hits:       list of (keyword_id, weighted_score) for each keyword found in the
+                            paragraph, keyword_id being the keyword's index in self.keywords
+
+            Results:
+                Stores the paragraph once, and a hit referencing it for each keyword, flushing
+                once 'batch_size' rows are buffered (streaming only)
+        '''
+        paragraph = ParagraphRecord(text, score, magnitude)
+        self.paragraphs.append(paragraph)
+        self.hits.extend(KeywordHit(paragraph, keyword_id, weighted_score) for keyword_id, weighted_score in hits)
+        self.flush_if_full()
+
+    def flush_if_full(self):
+        ''' Flushes once 'batch_size' rows are buffered (streaming only) '''
+        if self.target_file_path is not None and len(self.data) + len(self.hits) >= self.batch_size:
+            self.flush()
+
+    def get_rows(self, include_text=True):
+        '''
+            Args:
+                include_text: if False, rows have the paragraph's "ParagraphId" rather than its text
+
+            Returns:
+                The buffered data as a list of rows (dicts), one per keyword per paragraph, with
+                the paragraph, score, magnitude, weighted score and keyword entry
+        '''
+        rows = list(self.data)
+        for hit in self.hits:
+            paragraph = hit.paragraph
+            row = {'Paragraph': paragraph.text} if include_text else {'ParagraphId': paragraph.id}
+            row.update(Score=paragraph.score, Magnitude=paragraph.magnitude, WeightedScore=hit.weighted_score)
+            row.update(self.keywords[hit.keyword_id])
+            rows.append(row)
+        return rows
+
+    def get_paragraph_rows(self):
+        ''' Returns the buffered paragraphs as a list of rows (dicts), one per distinct paragraph '''
+        rows = {}
+        for paragraph in self.paragraphs:
+            if paragraph.id not in rows:
+                rows[paragraph.id] = {
+                    'ParagraphId': paragraph.id, 'Paragraph': paragraph.text,
+                    'Score': paragraph.score, 'Magnitude': paragraph.magnitude,
+                }
+        return list(rows.values())
+
     def get_data(self):
-        ''' Getter for self.data '''
-        return self.data
+        ''' Returns the buffered data as rows (see get_rows; when streaming, only rows not yet flushed) '''
+        return self.get_rows()
+
+    def get_hit_fields(self):
+        ''' Returns self.fields for rows with a "ParagraphId" instead of the paragraph text '''
+        return [('ParagraphId', 'string')] + [field for field in self.fields if field[0] != 'Paragraph']
+
+    def get_paragraph_file_path(self):
+        ''' Returns the file path paragraphs are written to in the normalized layout '''
+        stem, extension = os.path.splitext(self.target_file_path)
+        return stem + '.paragraphs' + extension
+
+    def flush(self):
+        '''
+            Results:
+                Writes the buffered rows (and paragraphs, in the normalized layout) to the
+                target file, passes them to on_flush, and clears the buffers
+        '''
+        if not self.data and not self.hits:
+            return
+        if self.writer is None:
+            self.open_writers()
+        if self.layout == 'flat':
+            self.write_rows(self.writer, self.get_rows(), self.fields)
+        else:
+            self.write_rows(self.writer, self.get_rows(include_text=False), self.get_hit_fields())
+            self.write_rows(self.paragraph_writer, self.get_paragraph_rows(), self.paragraph_fields)
+        if self.on_flush is not None:
+            self.on_flush(self.get_rows(include_text=False), self.get_paragraph_rows())
+        self.rows_written += len(self.data) + len(self.hits)
+        self.data = []
+        self.paragraphs = []
+        self.hits = []
+
+    def close(self):
+        '''
+            Results:
+                Flushes remaining rows and closes the target file(s) (written with just the
+                header/schema if there were no rows)
+        '''
+        self.flush()
+        if self.writer is None:
+            self.open_writers()
+        for file, writer in ((self.file, self.writer), (self.paragraph_file, self.paragraph_writer)):
+            if file is None:
+                continue
+            if self.file_format in ('parquet', 'arrow'):
+                writer.close()
+            file.close()
+
+    def discard(self):
+        '''
+            Results:
+                Drops buffered rows, and closes and deletes the target file(s) if they were
+                opened, so a failed transcript leaves no open handles or partial results
+        '''
+        self.data = []
+        self.paragraphs = []
+        self.hits = []
+        if self.writer is None:
+            return
+        for file, writer in ((self.file, self.writer), (self.paragraph_file, self.paragraph_writer)):
+            if file is None:
+                continue
+            # Columnar writers are closed first (even though the file is deleted), otherwise
+            # they try to write their footer to the closed file when collected
+            if self.file_format in ('parquet', 'arrow'):
+                with contextlib.suppress(Exception):
+                    writer.close()
+            file.close()
+            os.remove(file.name)
+        self.file = self.writer = self.paragraph_file = self.paragraph_writer = None
+
+    def get_field_names(self):
+        ''' Returns list of field names in self.fields '''
+        return [name for name, _ in self.fields]
+
+    def get_arrow_schema(self, fields=None):
+        ''' Returns 'fields' (default self.fields) as a pyarrow schema '''
+        import pyarrow as pa
+        return pa.schema([(name, pa.type_for_alias(field_type)) for name, field_type in fields or self.fields])
+
+    def open_writers(self):
+        ''' Opens the target file (and paragraph file, in the normalized layout) and their writers '''
+        if self.layout == 'flat':
+            self.file, self.writer = self.open_writer(self.target_file_path, self.fields)
+        else:
+            self.file, self.writer = self.open_writer(self.target_file_path, self.get_hit_fields())
+            self.paragraph_file, self.paragraph_writer = self.open_writer(self.get_paragraph_file_path(), self.paragraph_fields)
+
+    def open_writer(self, file_path, fields):
+        ''' Opens 'file_path' and a writer for 'fields' in self.file_format, returning (file, writer) '''
+        if self.file_format == 'csv':
+            file = open(file_path, mode='w', newline='')
+            writer = csv.DictWriter(file, fieldnames=[name for name, _ in fields], extrasaction='ignore')
+            writer.writeheader()
+            return file, writer
+
+        # pyarrow is only needed for the columnar formats
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        file = open(file_path, mode='wb')
+        if self.file_format == 'parquet':
+            return file, pq.ParquetWriter(file, self.get_arrow_schema(fields))
+        return file, pa.ipc.new_file(file, self.get_arrow_schema(fields))
+
+    def write_rows(self, writer, rows, fields):
+        ''' Writes 'rows' (list of dicts) with 'writer', which was opened for 'fields' '''
+        if self.file_format == 'csv':
+            writer.writerows(rows)
+            return
+
+        import pyarrow as pa
+        columns = {
+            name: [convert_value(row.get(name), field_type) for row in rows]
+            for name, field_type in fields
+        }
+        writer.write_table(pa.Table.from_pydict(columns, schema=self.get_arrow_schema(fields)))
 
     def save_as_csv(self, target_file_path):
         '''
@@ -254,23 +2130,75 @@ class DataManager:
                 target_file_path: File path for new CSV
             
             Results:
-                Saves the data in self.data as a CSV
+                Saves the buffered data as a CSV (one row per keyword per paragraph)
+                Columns are self.fields followed by any other keys found in the data
         '''
-        field_names = self.data[0].keys()
+        rows = self.get_rows()
+        field_names = self.get_field_names()
+        for row in rows:
+            for key in row:
+                if key not in field_names:
+                    field_names.append(key)
 
         # Open the file in write mode
         with open(target_file_path, mode='w', newline='') as file:
             writer = csv.DictWriter(file, fieldnames=field_names)
             writer.writeheader()
-            writer.writerows(self.data)
+            writer.writerows(rows)
+
+
+def convert_value(value, field_type):
+    '''
+        Args:
+            value:      value from a row of data
+            field_type: 'string', 'float64', 'int64' or 'bool'
+
+        Returns:
+            'value' converted to 'field_type' (None for missing values, including NaN)
+    '''
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if field_type == 'string':
+        return str(value)
+    if field_type == 'float64':
+        return float(value)
+    if field_type == 'int64':
+        return int(value)
+    return bool(value)
 
 
 # Interfaces with datastore
 class Database:
-    def __init__(self, key_filepath):
+    # Datastore allows at most 500 entities and 10MiB per commit
+    max_chunk_entities = 500
+    max_chunk_bytes = 8 * 1024 * 1024
+
+    def __init__(self, key_filepath=None, client=None, max_workers=4, max_retries=5):
         # Client is currently initialized using json file with key
-        # If environment variable is set, use: datastore.Client()
-        self.client = datastore.Client.from_service_account_json(key_filepath)
+        # Without a key file, datastore.Client() is used, which reads credentials from
+        # the environment and connects to the emulator if DATASTORE_EMULATOR_HOST is set
+        # A client (eg an in-process fake for testing) can also be passed in directly
+        if client is not None:
+            self.client = client
+        else:
+            from google.cloud import datastore
+            if key_filepath:
+                self.client = datastore.Client.from_service_account_json(key_filepath)
+            else:
+                self.client = datastore.Client()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+
+        # Errors that are worth retrying a write for
+        from google.api_core import exceptions as api_exceptions
+        self.transient_errors = (
+            api_exceptions.Aborted,
+            api_exceptions.DeadlineExceeded,
+            api_exceptions.InternalServerError,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.TooManyRequests,
+            api_exceptions.ResourceExhausted,
+        )
 
     def create_entity(self, kind, data, namespace=None):
         '''
@@ -286,5 +2214,262 @@ class Database:
         entity.update(data)
         self.client.put(entity=entity)
 
-    
-    
+    def create_entities(self, kind, data_list, namespace=None, key_field=None, exclude_from_indexes=(), rollback=False):
+        '''
+            Args:
+                kind:                   string containing datastore 'kind' for every item in 'data_list'
+                data_list:              list of data (dicts) to upload to datastore
+                namespace:              string containing datastore 'namespace' for 'data_list'
+                key_field:              field whose value is used as each entity's key name, so
+                                        uploading the same item twice overwrites it (None for
+                                        generated IDs)
+                exclude_from_indexes:   names of fields that aren't indexed (eg long text)
+                rollback:               if True and any chunk fails, every entity is deleted again
+                                        (so none are left behind) before the error is raised
+
+            Returns:
+                Number of entities uploaded
+
+            Results:
+                Uploads every item in 'data_list' to datastore with put_multi, split into
+                chunks that fit in a single commit. Chunks are uploaded concurrently by up to
+                self.max_workers threads, and retried with backoff on transient errors.
+                Without 'key_field', IDs are allocated before uploading, so a retried commit
+                that had already succeeded overwrites its entities rather than duplicating them.
+        '''
+        if key_field is None:
+            keys = self.allocate_keys(kind, len(data_list), namespace)
+        else:
+            keys = [self.client.key(kind, data[key_field], namespace=namespace) for data in data_list]
+        entities = []
+        for key, data in zip(keys, data_list):
+            entity = self.client.entity(key, exclude_from_indexes=exclude_from_indexes)
+            entity.update(data)
+            entities.append(entity)
+
+        chunks = list(self.split_chunks(entities))
+        try:
+            if len(chunks) == 1 or self.max_workers <= 1:
+                for chunk in chunks:
+                    self.put_chunk(chunk)
+            elif chunks:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                    # list() re-raises the first error from any chunk (once every chunk is done)
+                    list(executor.map(self.put_chunk, chunks))
+        except BaseException:
+            if rollback:
+                # Keys are complete, so deleting those never written is harmless
+                with contextlib.suppress(Exception):
+                    self.delete_keys([entity.key for entity in entities])
+            raise
+        return len(entities)
+
+    def delete_keys(self, keys):
+        ''' Deletes the entities with 'keys' from datastore, in chunks retried on transient errors '''
+        for start in range(0, len(keys), self.max_chunk_entities):
+            self.retry(self.client.delete_multi, keys[start:start + self.max_chunk_entities])
+
+    def allocate_keys(self, kind, count, namespace=None):
+        '''
+            Args:
+                kind:       string containing datastore 'kind' for the keys
+                count:      number of keys
+                namespace:  string containing datastore 'namespace' for the keys
+
+            Returns:
+                List of 'count' complete keys with IDs allocated by datastore, allocated in
+                chunks of self.max_chunk_entities and retried on transient errors
+        '''
+        incomplete_key = self.client.key(kind, namespace=namespace)
+        keys = []
+        while len(keys) < count:
+            size = min(self.max_chunk_entities, count - len(keys))
+            keys.extend(self.retry(self.client.allocate_ids, incomplete_key, size))
+        return keys
+
+    def split_chunks(self, entities):
+        '''
+            Args:
+                entities: list of datastore entities
+
+            Returns:
+                Generator of lists of entities, each within the per-commit entity and size limits
+        '''
+        chunk, chunk_bytes = [], 0
+        for entity in entities:
+            entity_bytes = self.estimate_size(entity)
+            if chunk and (len(chunk) >= self.max_chunk_entities or chunk_bytes + entity_bytes > self.max_chunk_bytes):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(entity)
+            chunk_bytes += entity_bytes
+        if chunk:
+            yield chunk
+
+    def estimate_size(self, entity):
+        ''' Returns rough size in bytes of 'entity' (property names and values as text) '''
+        return 100 + sum(len(str(key)) + len(str(value)) for key, value in entity.items())
+
+    def put_chunk(self, chunk):
+        '''
+            Args:
+                chunk: list of datastore entities that fit in a single commit
+
+            Results:
+                Uploads 'chunk' with put_multi, retrying transient errors (see retry). Every
+                entity must have a complete key, so a repeated commit overwrites rather than inserts.
+        '''
+        self.retry(self.client.put_multi, chunk)
+
+    def retry(self, function, *args):
+        '''
+            Returns:
+                function(*args), retrying transient errors with exponential backoff (and jitter)
+                up to self.max_retries times
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args)
+            except self.transient_errors:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+
+
+def measure_startup(model_name='ProsusAI/finBERT', backend='torch'):
+    '''
+        Args:
+            model_name: sentiment model name or path
+            backend:    'torch', 'onnx' or 'onnx-int8'
+
+        Returns:
+            Dictionary of seconds taken by each part of a cold start: importing this module,
+            checking nltk data, loading the model and tokenizer, and scoring a first paragraph
+    '''
+    timings = {'import': module_load_time}
+
+    start = time.perf_counter()
+    ensure_nltk_data()
+    timings['nltk_data'] = time.perf_counter() - start
+
+    sentiment_analyzer = SentimentAnalyzer(model_name, backend=backend)
+    start = time.perf_counter()
+    sentiment_analyzer.backend.load()
+    sentiment_analyzer.tokenizer
+    timings['model'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sentiment_analyzer.analyze_sentiment('Revenue grew strongly this quarter.')
+    timings['first_paragraph'] = time.perf_counter() - start
+    return timings
+
+
+module_load_time = time.perf_counter() - module_load_start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score transcripts for keyword sentiment')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    process_parser = subparsers.add_parser('process', help='score every transcript (docx) in a directory')
+    process_parser.add_argument('directory', help='directory of transcripts')
+    process_parser.add_argument('keywords', help='keyword excel file')
+    process_parser.add_argument('--output-dir', help='directory for results (defaults to the transcript directory)')
+    process_parser.add_argument('--format', default='csv', choices=['csv', 'parquet', 'arrow'], help='results file format')
+    process_parser.add_argument('--layout', default='flat', choices=['flat', 'normalized'], help='write a row per keyword with its paragraph (flat), or paragraphs once to a second file (normalized)')
+    process_parser.add_argument('--processes', type=int, help='number of worker processes')
+    process_parser.add_argument('--threads', type=int, help='torch threads per worker process')
+    process_parser.add_argument('--batch-size', type=int, default=16, help='most paragraphs per model batch')
+    process_parser.add_argument('--model', default='ProsusAI/finBERT', help='sentiment model name or path')
+    process_parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'onnx-int8'], help='sentiment model backend')
+    process_parser.add_argument('--cache', help='sentiment cache file')
+    process_parser.add_argument('--no-upload', action='store_true', help='offline mode, results are not uploaded to datastore')
+    process_parser.add_argument('--key', default='key.json', help='datastore key file')
+    process_parser.add_argument('--windowed', action='store_true', help='score paragraphs over the model\'s token limit from overlapping windows instead of truncating them')
+    process_parser.add_argument('--cascade-threshold', type=float, help='score paragraphs whose absolute mean VADER score is at least this with VADER alone')
+    process_parser.add_argument('--cascade-calibration', type=float, nargs=2, default=(1.0, 0.0), metavar=('SLOPE', 'INTERCEPT'), help='mapping from mean VADER score to sentiment score (from cascade-report)')
+    process_parser.add_argument('--store', help='paragraph store file, saving scored paragraphs for rejoin')
+    process_parser.add_argument('--word-boundaries', action='store_true', help='only match keywords as whole words')
+    process_parser.add_argument('--score-all', action='store_true', help='score (and store) every paragraph, not just those matching keywords')
+    process_parser.add_argument('--metrics-json', help='JSON lines file to append each transcript\'s stage timings and counters to')
+    process_parser.add_argument('--metrics-prom', help='Prometheus text file for stage timings and counters ({pid} is replaced by the process id, which is added automatically with more than one worker process)')
+
+    startup_parser = subparsers.add_parser('startup-time', help='measure cold start time (printed as JSON)')
+    startup_parser.add_argument('--model', default='ProsusAI/finBERT', help='sentiment model name or path')
+    startup_parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'onnx-int8'], help='sentiment model backend')
+
+    export_parser = subparsers.add_parser('export-onnx', help='export the sentiment model to ONNX')
+    export_parser.add_argument('file', help='file path for the ONNX model')
+    export_parser.add_argument('--model', default='ProsusAI/finBERT', help='sentiment model name or path')
+    export_parser.add_argument('--quantize', action='store_true', help='dynamically quantize the model to int8')
+
+    parity_parser = subparsers.add_parser('parity', help='compare a backend against torch (printed as JSON)')
+    parity_parser.add_argument('transcripts', nargs='+', help='transcripts (docx) to sample paragraphs from')
+    parity_parser.add_argument('--model', default='ProsusAI/finBERT', help='sentiment model name or path')
+    parity_parser.add_argument('--backend', default='onnx-int8', choices=['onnx', 'onnx-int8'], help='backend to compare')
+    parity_parser.add_argument('--onnx-file', help='file path of the ONNX model')
+    parity_parser.add_argument('--sample', type=int, default=200, help='number of paragraphs to sample')
+
+    cascade_parser = subparsers.add_parser('cascade-report', help='report cascade escalation rate and agreement with the model (printed as JSON)')
+    cascade_parser.add_argument('transcripts', nargs='+', help='transcripts (docx) to sample paragraphs from')
+    cascade_parser.add_argument('--model', default='ProsusAI/finBERT', help='sentiment model name or path')
+    cascade_parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'onnx-int8'], help='sentiment model backend')
+    cascade_parser.add_argument('--thresholds', type=float, nargs='+', default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7], help='cascade thresholds to report on')
+    cascade_parser.add_argument('--sample', type=int, default=500, help='number of paragraphs to sample')
+
+    rejoin_parser = subparsers.add_parser('rejoin', help='rebuild results from a paragraph store with a keyword file, without the model')
+    rejoin_parser.add_argument('store', help='paragraph store file (from process --store)')
+    rejoin_parser.add_argument('keywords', help='keyword excel file')
+    rejoin_parser.add_argument('--output-dir', default='.', help='directory for results')
+    rejoin_parser.add_argument('--format', default='csv', choices=['csv', 'parquet', 'arrow'], help='results file format')
+    rejoin_parser.add_argument('--layout', default='flat', choices=['flat', 'normalized'], help='results layout (see process)')
+    rejoin_parser.add_argument('--word-boundaries', action='store_true', help='only match keywords as whole words')
+    rejoin_parser.add_argument('--company', nargs='+', help='only rejoin these companies')
+    rejoin_parser.add_argument('--period', nargs='+', help='only rejoin these periods (QxYYYY)')
+
+    args = parser.parse_args()
+    if args.command == 'process':
+        exporters = []
+        if args.metrics_json:
+            exporters.append(JsonExporter(args.metrics_json))
+        if args.metrics_prom:
+            exporters.append(PrometheusExporter(args.metrics_prom))
+        results = Handler.process_directory(
+            args.directory, args.keywords, args.output_dir, args.processes, args.threads, args.format,
+            model_name=args.model, cache_file_path=args.cache, upload=not args.no_upload, key_filepath=args.key,
+            backend=args.backend, layout=args.layout, cascade_threshold=args.cascade_threshold,
+            cascade_calibration=args.cascade_calibration, windowed=args.windowed, store_file_path=args.store,
+            score_all=args.score_all, word_boundaries=args.word_boundaries, batch_size=args.batch_size, instrumentation=Instrumentation(exporters) if exporters else None
+        )
+        failures = [result for result in results if result['Error']]
+        for result in results:
+            if result['Error']:
+                print(f"FAILED {result['Transcript']}\n{result['Error']}")
+            else:
+                print(f"{result['Transcript']} -> {result['Output']}")
+        print(f'{len(results) - len(failures)} of {len(results)} transcripts processed')
+        if failures:
+            raise SystemExit(1)
+    elif args.command == 'rejoin':
+        output_file_paths = rejoin(args.store, args.keywords, args.output_dir, args.format, args.layout, args.company, args.period,
+                                   word_boundaries=args.word_boundaries)
+        print(f'{len(output_file_paths)} transcripts rejoined')
+    elif args.command == 'startup-time':
+        print(json.dumps(measure_startup(args.model, args.backend), indent=2))
+    elif args.command == 'export-onnx':
+        export_onnx(args.model, args.file, args.quantize)
+    elif args.command == 'parity':
+        paragraphs = []
+        for transcript in args.transcripts:
+            paragraphs.extend(TranscriptProcessor(transcript).get_paragraphs())
+        sample = random.Random(0).sample(paragraphs, min(args.sample, len(paragraphs)))
+        reference = SentimentAnalyzer(args.model)
+        candidate = SentimentAnalyzer(args.model, backend=args.backend, onnx_file_path=args.onnx_file)
+        print(json.dumps(check_backend_parity(sample, reference, candidate), indent=2))
+    elif args.command == 'cascade-report':
+        paragraphs = []
+        for transcript in args.transcripts:
+            paragraphs.extend(TranscriptProcessor(transcript, streaming=True).iter_paragraphs())
+        sample = random.Random(0).sample(paragraphs, min(args.sample, len(paragraphs)))
+        sentiment_analyzer = SentimentAnalyzer(args.model, backend=args.backend)
+        print(json.dumps(check_cascade(sample, sentiment_analyzer, args.thresholds), indent=2))
@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from sentiment import (SentimentAnalyzer, SentimentCache, ParagraphStore, KeywordAnalyzer, TranscriptProcessor, DataManager, Database,
+                       UploadBuffer, get_output_name, get_store_labels, save_results, upload_results)
+
+# Long-running scoring service: keeps the model loaded and scores transcript requests as they
+# arrive, read as JSON lines from stdin or posted over HTTP. Paragraphs from every request in
+# flight share the same model batches.
+
+
+# Scores transcripts like Handler.process_request(), for many requests at once
+# Keyword-matching paragraphs of every request are put on a single bounded queue, and a
+# batcher runs them through the model in batches of up to max_batch_size, waiting at most
+# max_wait seconds for a batch to fill. Each paragraph's result goes back to its request.
+class ScoringService:
+    def __init__(self, model_name='ProsusAI/finBERT', cache_file_path=None, upload=True, key_filepath="key.json",
+                 backend='torch', max_batch_size=64, max_wait=0.01, max_queue=1024, max_requests=32,
+                 cascade_threshold=None, cascade_calibration=(1.0, 0.0), windowed=False, store_file_path=None, score_all=False,
+                 word_boundaries=False):
+        '''
+            Args:
+                model_name:         sentiment model name or path
+                cache_file_path:    file path for a SentimentCache (None for no cache)
+                upload:             if False (offline), results are never uploaded
+                key_filepath:       datastore key file
+                backend:            sentiment model backend, 'torch', 'onnx' or 'onnx-int8'
+                max_batch_size:     most paragraphs run through the model at once
+                max_wait:           longest time (seconds) a paragraph waits for its batch to fill
+                max_queue:          most paragraphs waiting to be scored, requests wait to add
+                                    more paragraphs once it is full
+                max_requests:       most requests processed at once
+                cascade_threshold:  see Handler
+                cascade_calibration:see Handler
+                windowed:           see Handler
+                store_file_path:    see Handler
+                score_all:          see Handler
+                word_boundaries:    see Handler
+        '''
+        cache = SentimentCache(cache_file_path) if cache_file_path else None
+        self.sentiment_analyzer = SentimentAnalyzer(model_name, batch_size=max_batch_size, cache=cache, backend=backend,
+                                                    cascade_threshold=cascade_threshold,
+                                                    cascade_calibration=cascade_calibration, windowed=windowed)
+        self.store = ParagraphStore(store_file_path) if store_file_path else None
+        self.score_all = score_all
+        self.word_boundaries = word_boundaries
+        self.upload_enabled = upload
+        self.key_filepath = key_filepath
+        self.database = None
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.max_requests = max_requests
+        # (modification time, KeywordAnalyzer) for each keyword file, replaced when the file changes
+        self.keyword_analyzers = {}
+        # The model is only ever run by this thread, files are read and written by the others
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+        self.io_executor = ThreadPoolExecutor(max_workers=max_requests)
+        self.queue = None
+        self.requests = None
+        self.batcher = None
+        self.stats = {'requests': 0, 'failed': 0, 'paragraphs': 0, 'batches': 0}
+
+    async def start(self):
+        '''
+            Results:
+                Loads the model (scoring a first paragraph) and starts the batcher
+        '''
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.requests = asyncio.Semaphore(self.max_requests)
+        if self.upload_enabled:
+            self.database = Database(self.key_filepath)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.model_executor, self.sentiment_analyzer.analyze_batch, ['Warm up the model.'])
+        self.batcher = asyncio.create_task(self.run_batcher())
+
+    async def stop(self):
+        ''' Stops the batcher and the executors '''
+        if self.batcher is not None:
+            self.batcher.cancel()
+            await asyncio.gather(self.batcher, return_exceptions=True)
+        self.model_executor.shutdown()
+        self.io_executor.shutdown()
+
+    def is_full(self):
+        ''' Returns True if max_requests requests are already being processed '''
+        return self.requests.locked()
+
+    async def run_batcher(self):
+        '''
+            Results:
+                Forever takes paragraphs from self.queue, up to max_batch_size at a time (or as
+                many as arrive within max_wait of the first), scores them as a batch, and sets
+                each paragraph's future to its (score, magnitude)
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Requests that failed (or were cancelled) no longer need their paragraphs
+            batch = [(paragraph, future) for paragraph, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(
+                    self.model_executor, self.sentiment_analyzer.analyze_batch, [paragraph for paragraph, _ in batch]
+                )
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.stats['batches'] += 1
+            self.stats['paragraphs'] += len(batch)
+
+    def get_keyword_analyzer(self, keywords_file_path):
+        ''' Returns the KeywordAnalyzer for 'keywords_file_path', read again if the file changed '''
+        path = os.path.abspath(keywords_file_path)
+        mtime = os.path.getmtime(path)
+        cached = self.keyword_analyzers.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, KeywordAnalyzer(path, self.word_boundaries))
+            self.keyword_analyzers[path] = cached
+        return cached[1]
+
+    def find_matches(self, transcript_file_path, keyword_analyzer):
+        '''
+            Returns:
+                Tuple of (number of paragraphs, list of (paragraph, keyword_ids, position) for every
+                keyword-matching paragraph in the transcript, or every paragraph with score_all)
+        '''
+        paragraphs = 0
+        matches = []
+        for position, paragraph in enumerate(TranscriptProcessor(transcript_file_path, streaming=True).iter_paragraphs()):
+            paragraphs += 1
+            keyword_ids = keyword_analyzer.find_keyword_ids(paragraph)
+            if keyword_ids or self.score_all:
+                matches.append((paragraph, keyword_ids, position))
+        return paragraphs, matches
+
+    def upload(self, rows, paragraphs):
+        ''' Uploads each paragraph once, and 'rows' referencing them (see upload_results) '''
+        upload_results(self.database, rows, paragraphs)
+
+    def save_results(self, output_file_path, keyword_analyzer, matches, results, layout='flat', store_labels=None):
+        '''
+            Returns:
+                Number of rows saved
+
+            Results:
+                Saves each paragraph in 'matches' with its (score, magnitude) from 'results' and
+                its keywords (see sentiment.save_results), then uploads them (unless offline).
+                Once that succeeds, they replace the transcript's paragraphs in the store (if
+                there is one). Partial results are deleted if saving or uploading fails.
+        '''
+        upload_buffer = UploadBuffer() if self.upload_enabled else None
+        data_manager = DataManager(output_file_path, keyword_analyzer.get_fields(), on_flush=upload_buffer.add if upload_buffer else None,
+                                   keywords=keyword_analyzer.keywords, layout=layout)
+        store_items = [] if self.store is not None else None
+        try:
+            save_results(data_manager, keyword_analyzer, self.sentiment_analyzer, matches, results, store_items)
+            data_manager.close()
+            if upload_buffer is not None:
+                self.upload(upload_buffer.rows, upload_buffer.get_paragraphs())
+        except BaseException:
+            data_manager.discard()
+            raise
+        if self.store is not None:
+            self.store.replace_transcript(*store_labels, self.sentiment_analyzer.model_id, store_items)
+        return data_manager.rows_written
+
+    async def process_request(self, request):
+        '''
+            Args:
+                request: dictionary with 'transcript' and 'keywords' file paths, and optionally
+                         'id', 'company', 'date', 'output' (results file path, defaults to
+                         get_output_name(company, date)) and 'layout' ('flat' or 'normalized')
+
+            Returns:
+                Dictionary with the request 'id', the 'output' file path, numbers of 'paragraphs',
+                'matches' and 'rows', the 'seconds' taken, and the 'error' traceback (None on success)
+        '''
+        start = time.perf_counter()
+        if not isinstance(request, dict):
+            return {'id': None, 'output': None, 'error': 'Request must be a JSON object', 'seconds': 0.0}
+        response = {'id': request.get('id'), 'output': None, 'error': None}
+        loop = asyncio.get_running_loop()
+        futures = []
+        async with self.requests:
+            try:
+                output_file_path = request.get('output') or get_output_name(request.get('company'), request.get('date'))
+                keyword_analyzer = await loop.run_in_executor(self.io_executor, self.get_keyword_analyzer, request['keywords'])
+                paragraphs, matches = await loop.run_in_executor(
+                    self.io_executor, self.find_matches, request['transcript'], keyword_analyzer
+                )
+
+                # Waits here while the queue is full
+                for paragraph, _, _ in matches:
+                    future = loop.create_future()
+                    futures.append(future)
+                    await self.queue.put((paragraph, future))
+                results = await asyncio.gather(*futures)
+
+                store_labels = get_store_labels(request['transcript'], request.get('company'), request.get('date'))
+                rows = await loop.run_in_executor(
+                    self.io_executor, self.save_results, output_file_path, keyword_analyzer, matches, results,
+                    request.get('layout', 'flat'), store_labels
+                )
+                matched = sum(1 for _, keyword_ids, _ in matches if keyword_ids)
+                response.update(output=output_file_path, paragraphs=paragraphs, matches=matched, rows=rows)
+            except Exception:
+                response['error'] = traceback.format_exc()
+                self.stats['failed'] += 1
+                for future in futures:
+                    future.cancel()
+        self.stats['requests'] += 1
+        response['seconds'] = time.perf_counter() - start
+        return response
+
+
+async def serve_stdin(service):
+    '''
+        Args:
+            service: started ScoringService
+
+        Results:
+            Reads a JSON request (see ScoringService.process_request) per line from stdin and
+            writes a JSON response per line to stdout as each request finishes (not necessarily
+            in order, use 'id' to match them). Reading stops while max_requests are in progress.
+    '''
+    loop = asyncio.get_running_loop()
+
+    async def respond(request):
+        response = await service.process_request(request)
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+    tasks = set()
+    while True:
+        # Read in a thread, since stdin may be a file (which asyncio can't read without blocking)
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as error:
+            sys.stdout.write(json.dumps({'id': None, 'output': None, 'error': f'Invalid JSON: {error}'}) + '\n')
+            sys.stdout.flush()
+            continue
+        # Backpressure: wait for a free slot before reading the next request
+        while service.is_full():
+            await asyncio.sleep(service.max_wait)
+        task = asyncio.create_task(respond(request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+async def handle_http(service, reader, writer):
+    '''
+        Results:
+            Answers a single HTTP request: POST / with a JSON request body is processed by
+            'service' (503 if it is already processing max_requests), GET /stats returns
+            service.stats
+    '''
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        if len(request_line) < 2:
+            status, response = 400, {'error': 'Bad request'}
+        elif request_line[0] == 'GET' and request_line[1] == '/stats':
+            status, response = 200, service.stats
+        elif request_line[0] != 'POST':
+            status, response = 405, {'error': 'Use POST with a JSON request body'}
+        elif service.is_full():
+            status, response = 503, {'error': 'Too many requests in progress, retry later'}
+        else:
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError as error:
+                status, response = 400, {'error': f'Invalid JSON: {error}'}
+            else:
+                response = await service.process_request(request)
+                status = 500 if response['error'] else 200
+
+        content = json.dumps(response).encode()
+        retry_after = 'Retry-After: 1\r\n' if status == 503 else ''
+        reasons = {200: 'OK', 400: 'Bad Request', 405: 'Method Not Allowed', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+        writer.write(
+            f'HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(content)}\r\n{retry_after}Connection: close\r\n\r\n'.encode() + content
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_http(service, host, port):
+    '''
+        Results:
+            Serves HTTP requests (see handle_http) on 'host':'port' until cancelled
+    '''
+    server = await asyncio.start_server(lambda reader, writer: handle_http(service, reader, writer), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def main(args):
+    service = ScoringService(
+        args.model, args.cache, not args.no_upload, args.key, args.backend,
+        args.max_batch_size, args.max_wait_ms / 1000, args.max_queue, args.max_requests,
+        args.cascade_threshold, args.cascade_calibration, args.windowed, args.store, args.score_all,
+        args.word_boundaries
+    )
+    await service.start()
+    try:
+        if args.http:
+            host, _, port = args.http.rpartition(':')
+            await serve_http(service, host or '127.0.0.1', int(port))
+        else:
+            await serve_stdin(service)
+    finally:
+        await service.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-running transcript scoring service')
+    parser.add_argument('--http', help='serve HTTP on [HOST:]PORT instead of reading JSON lines from stdin')
+    parser.add_argument('--model', default='ProsusAI/finBERT', help='sentiment model name or path')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx', 'onnx-int8'], help='sentiment model backend')
+    parser.add_argument('--cache', help='sentiment cache file')
+    parser.add_argument('--no-upload', action='store_true', help='offline mode, results are not uploaded to datastore')
+    parser.add_argument('--key', default='key.json', help='datastore key file')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='most paragraphs per model batch')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='longest wait for a model batch to fill')
+    parser.add_argument('--max-queue', type=int, default=1024, help='most paragraphs waiting to be scored')
+    parser.add_argument('--max-requests', type=int, default=32, help='most requests processed at once')
+    parser.add_argument('--windowed', action='store_true', help='score paragraphs over the model\'s token limit from overlapping windows instead of truncating them')
+    parser.add_argument('--cascade-threshold', type=float, help='score paragraphs whose absolute mean VADER score is at least this with VADER alone')
+    parser.add_argument('--cascade-calibration', type=float, nargs=2, default=(1.0, 0.0), metavar=('SLOPE', 'INTERCEPT'), help='mapping from mean VADER score to sentiment score (from cascade-report)')
+    parser.add_argument('--store', help='paragraph store file, saving scored paragraphs for rejoin')
+    parser.add_argument('--word-boundaries', action='store_true', help='only match keywords as whole words')
+    parser.add_argument('--score-all', action='store_true', help='score (and store) every paragraph, not just those matching keywords')
+    asyncio.run(main(parser.parse_args()))
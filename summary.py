@@ -1,6 +1,33 @@
+import argparse
+import io
+import os
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 from google.cloud import datastore
+from sentiment import Database, parse_transcript_name
 
-client = datastore.Client.from_service_account_json("key.json")
+# Datastore client, connected on first use (see get_client)
+client = None
+
+def get_client(key_filepath="key.json"):
+    '''
+    Input:
+        key_filepath: json file with the datastore key
+
+    Returns:
+        The datastore client, created on first use. Connects to the emulator instead if
+        DATASTORE_EMULATOR_HOST is set. Set summary.client directly to use another client
+        (eg an in-process fake for testing).
+    '''
+    global client
+    if client is None:
+        if os.environ.get("DATASTORE_EMULATOR_HOST"):
+            client = datastore.Client()
+        else:
+            client = datastore.Client.from_service_account_json(key_filepath)
+    return client
 
 def query_company_quarter(company, quarter, kind):
     '''
@@ -14,7 +41,7 @@ def query_company_quarter(company, quarter, kind):
                                 from 'company' during 'quarter'. Can be filtered by other keys (eg Category)
                                 if properly indexed.
     '''
-    sentiment_query = client.query(kind=kind)
+    sentiment_query = get_client().query(kind=kind)
     company_query = sentiment_query.add_filter("YahooTicker", "=", company)
     company_quarter_query = company_query.add_filter("Period", "=", quarter)
     return company_quarter_query
@@ -22,32 +49,82 @@ def query_company_quarter(company, quarter, kind):
 # scoring categories
 categories = ["Macro", "Sector trend", "Financial metric - All", "Financial metric - Bank", "Regulation"]
 
-def get_category_scores(company, quarter, kind):
+def fetch_company_quarter_scores(company, quarter, kind):
+    '''
+    Input:
+        company: Yahoo Ticker of company
+        quarter: quarter to query, in QxYYYY format
+        kind: The Datastore kind of the score entities
+
+    Returns:
+        List of (Category, Score, WeightedSentiment) for every score entity from 'company'
+        during 'quarter', fetched with a single query. Full entities are fetched rather than
+        a projection, since a projection skips entities missing a projected property, which
+        would change the counts. Properties are read under any of their names in local_columns,
+        since Handler uploads "Key Word Category" and "WeightedScore".
+    '''
+    entities = query_company_quarter(company, quarter, kind).fetch()
+    fields = ("Category", "Score", "WeightedSentiment")
+    return [tuple(get_entity_value(entity, field) for field in fields) for entity in entities]
+
+def get_entity_value(entity, field):
+    '''
+    Input:
+        entity: score entity
+        field: summary field, a key of local_columns (eg "WeightedSentiment")
+
+    Returns:
+        The value of the first of the field's names in local_columns that 'entity' has, None if none
+    '''
+    return next((entity[name] for name in local_columns[field] if name in entity), None)
+
+def average(values):
+    '''
+    Returns:
+        Average of the numeric items in 'values' (like a datastore AvgAggregation), None if there are none
+    '''
+    numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+    return sum(numbers) / len(numbers) if numbers else None
+
+def aggregate_category_scores(scores):
+    '''
+    Input:
+        scores: list of (Category, Score, WeightedSentiment), eg from fetch_company_quarter_scores
+
+    Returns:
+        category_scores: count, average score and (normalized) average weighted score for each
+                         category, with the same keys and values as the datastore aggregation
+                         queries ("{category} Count", "{category} Average", "{category} Weighted Average")
+    '''
     category_scores = {}
     for category in categories:
-        company_quarter_q = query_company_quarter(company, quarter, kind)
-        company_quarter_q.add_filter("Category", "=", category)
-        aggregation_query = client.aggregation_query(company_quarter_q)
-        aggregation_query.add_aggregations(
-            [
-                datastore.aggregation.CountAggregation(alias=f"{category} Count"),
-                datastore.aggregation.AvgAggregation(property_ref="Score", alias=f"{category} Average"),
-                datastore.aggregation.AvgAggregation(property_ref="WeightedSentiment", alias=f"{category} Weighted Average")
-            ]
-        )
-        query_result = aggregation_query.fetch()
-        for aggregation_results in query_result:
-            for aggregation in aggregation_results:
-                if "Weighted" in aggregation.alias:
-                    # Normalize weighted scores from [0, 1] to [-1, 1] (0 if no values)
-                    category_scores[aggregation.alias] = 2*aggregation.value - 1 if aggregation.value else 0
-                else:
-                    category_scores[aggregation.alias] = aggregation.value
+        category_rows = [row for row in scores if row[0] == category]
+        weighted_average = average([row[2] for row in category_rows])
+        category_scores[f"{category} Count"] = len(category_rows)
+        category_scores[f"{category} Average"] = average([row[1] for row in category_rows])
+        # Normalize weighted scores from [0, 1] to [-1, 1] (0 if no values)
+        category_scores[f"{category} Weighted Average"] = 2*weighted_average - 1 if weighted_average else 0
     return category_scores
 
+def get_category_scores(company, quarter, kind):
+    '''
+    Input:
+        company: Yahoo Ticker of company
+        quarter: quarter to query, in QxYYYY format
+        kind: The Datastore kind of the score entities
+
+    Returns:
+        category_scores for 'company' during 'quarter' (see aggregate_category_scores), from a
+        single fetch aggregated locally rather than one aggregation query per category
+    '''
+    return aggregate_category_scores(fetch_company_quarter_scores(company, quarter, kind))
+
 def get_total_scores(category_scores):
     total, weighted, count = 0, 0, 0
     for category in categories:
+        # Categories without entities have no average
+        if not category_scores[f"{category} Count"]:
+            continue
         total += category_scores[f"{category} Average"] * category_scores[f"{category} Count"]
         weighted += category_scores[f"{category} Weighted Average"] * category_scores[f"{category} Count"]
         count += category_scores[f"{category} Count"]
@@ -66,16 +143,200 @@ def summarize_company_quarter(company, quarter, kind):
     summary["Period"] = quarter
     return summary
 
+def summarize_companies(quarters, companies, kind, max_workers=8):
+    '''
+    Input:
+        quarters: quarters to summarize, in QxYYYY format
+        companies: Yahoo Tickers of companies to summarize
+        kind: The Datastore kind of the score entities
+        max_workers: maximum number of company-quarters fetched at once
+
+    Returns:
+        List of summaries (see summarize_company_quarter), for each company and quarter in order
+    '''
+    get_client()
+    pairs = [(company, quarter) for company in companies for quarter in quarters]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda pair: summarize_company_quarter(*pair, kind), pairs))
+
 def upload_summary(summary):
-    entity = datastore.Entity(client.key("Banks_Summary"))
+    entity = datastore.Entity(get_client().key("Banks_Summary"))
     for key, item in summary.items():
         entity[key] = item
-    client.put(entity)
+    get_client().put(entity)
+
+def upload_summaries(summaries):
+    '''
+    Input:
+        summaries: list of summaries (see summarize_company_quarter)
+
+    Result:
+        Uploads every summary under 'Banks_Summary' with bulk (put_multi) writes
+    '''
+    Database(client=get_client()).create_entities("Banks_Summary", summaries)
 
 def upload_companies(quarters, companies, kind):
-    for company in companies:
-        for quarter in quarters:
-            summary = summarize_company_quarter(company, quarter, kind)
-            upload_summary(summary)
+    summaries = summarize_companies(quarters, companies, kind)
+    upload_summaries(summaries)
+
+
+# Offline summaries, from local score files instead of datastore
+
+# Column names used for each summary field, in DataManager outputs (and the datastore entities
+# Handler uploads), in older datastore entities, and in score excel files (eg example_scores.zip)
+local_columns = {
+    "Category": ["Category", "Key Word Category"],
+    "Score": ["Score", "Sentiment Score"],
+    "WeightedSentiment": ["WeightedSentiment", "WeightedScore", "Weighted Sentiment Score"],
+}
+local_extensions = (".csv", ".parquet", ".arrow", ".feather", ".xlsx")
+
+def parse_score_file_name(file_path):
+    '''
+    Input:
+        file_path: score file path, named like CC_{company}_Q{quarter}{year}_{month}_{day}_{year}.xlsx
+                   or {company}_{YYYY-MM-DD}.csv (DataManager output)
+
+    Returns:
+        Tuple of (company, period), eg ('WM US', 'Q42022'). The period of a DataManager output
+        is the calendar quarter of the call date, which is how score files are labelled.
+        (None, None) if the name matches neither format.
+    '''
+    company, period, _ = parse_transcript_name(file_path)
+    if period:
+        return company, period
+    match = re.fullmatch(r'(.+)_(\d{4})-(\d{2})-\d{2}', company)
+    if match:
+        return match.group(1), f"Q{(int(match.group(3)) - 1) // 3 + 1}{match.group(2)}"
+    return None, None
+
+def read_local_table(file, file_name):
+    '''
+    Input:
+        file: path or file object of a score file
+        file_name: name of the score file (its extension picks the reader)
+
+    Returns:
+        The score file as a DataFrame
+    '''
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".csv":
+        return pd.read_csv(file)
+    if extension == ".parquet":
+        return pd.read_parquet(file)
+    if extension in (".arrow", ".feather"):
+        return pd.read_feather(file)
+    return pd.read_excel(file, engine='openpyxl')
+
+def iter_local_tables(paths):
+    '''
+    Input:
+        paths: score files, directories of score files, or zip archives of score files
+
+    Returns:
+        Generator of (file name, DataFrame) for every score file in 'paths'
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            for file_name in sorted(os.listdir(path)):
+                if file_name.lower().endswith(local_extensions):
+                    yield file_name, read_local_table(os.path.join(path, file_name), file_name)
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for file_name in archive.namelist():
+                    if file_name.lower().endswith(local_extensions):
+                        yield file_name, read_local_table(io.BytesIO(archive.read(file_name)), file_name)
+        else:
+            yield path, read_local_table(path, path)
+
+def load_local_scores(paths):
+    '''
+    Input:
+        paths: score files, directories of score files, or zip archives of score files
+
+    Returns:
+        DataFrame with a row per keyword match from every file, with columns "YahooTicker",
+        "Period", "Category", "Score" and "WeightedSentiment". Company and period come from
+        "YahooTicker" and "Period" columns if the file has them, otherwise its name.
+    '''
+    frames = []
+    for file_name, df in iter_local_tables(paths):
+        frame = pd.DataFrame(index=df.index)
+        for field, names in local_columns.items():
+            column = next((name for name in names if name in df), None)
+            frame[field] = df[column] if column else None
+        for field in ("Score", "WeightedSentiment"):
+            frame[field] = pd.to_numeric(frame[field], errors="coerce")
+
+        company, period = parse_score_file_name(file_name)
+        frame["YahooTicker"] = df["YahooTicker"] if "YahooTicker" in df else company
+        frame["Period"] = df["Period"] if "Period" in df else period
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=["YahooTicker", "Period", *local_columns])
+    return pd.concat(frames, ignore_index=True)
+
+def summarize_local(paths):
+    '''
+    Input:
+        paths: score files, directories of score files, or zip archives of score files
+
+    Returns:
+        List of summaries (see summarize_company_quarter) for every company and quarter in
+        'paths', sorted by company then quarter. All categories are aggregated in a single
+        groupby rather than per company-quarter.
+    '''
+    scores = load_local_scores(paths).dropna(subset=["YahooTicker", "Period"])
+    grouped = scores.groupby(["YahooTicker", "Period", "Category"])
+    aggregates = pd.DataFrame({
+        "Count": grouped.size(),
+        "Average": grouped["Score"].mean(),
+        "Weighted Average": grouped["WeightedSentiment"].mean(),
+    })
+
+    company_quarters = scores[["YahooTicker", "Period"]].drop_duplicates()
+    company_quarters = sorted(
+        company_quarters.itertuples(index=False, name=None),
+        key=lambda pair: (pair[0], pair[1][2:], pair[1][:2])
+    )
+    summaries = []
+    for company, quarter in company_quarters:
+        category_scores = {}
+        for category in categories:
+            key = (company, quarter, category)
+            count = int(aggregates.at[key, "Count"]) if key in aggregates.index else 0
+            score_average = aggregates.at[key, "Average"] if count else None
+            weighted_average = aggregates.at[key, "Weighted Average"] if count else None
+            # Averages without values are None (as from datastore)
+            score_average = None if score_average is None or pd.isna(score_average) else float(score_average)
+            weighted_average = None if weighted_average is None or pd.isna(weighted_average) else float(weighted_average)
+            category_scores[f"{category} Count"] = count
+            category_scores[f"{category} Average"] = score_average
+            # Normalize weighted scores from [0, 1] to [-1, 1] (0 if no values)
+            category_scores[f"{category} Weighted Average"] = 2*weighted_average - 1 if weighted_average else 0
+
+        total, weighted = get_total_scores(category_scores)
+        category_scores["Total Average"] = total
+        category_scores["Weighted Average"] = weighted
+        category_scores["Yahoo Ticker"] = company
+        category_scores["Period"] = quarter
+        summaries.append(category_scores)
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize sentiment scores per company and quarter')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('upload', help='summarize the scores in datastore and upload the summaries (default)')
+
+    local_parser = subparsers.add_parser('local', help='summarize local score files')
+    local_parser.add_argument('paths', nargs='+', help='score files, directories, or zip archives')
+    local_parser.add_argument('--output', default='summaries.csv', help='CSV file for the summaries')
 
-upload_companies(["Q32021", "Q42021", "Q12022", "Q22022", "Q32022", "Q42022", "Q12023", "Q22023"], ["BAC US", "C US", "GS US", "JPM US", "WFC US"], "Banks")
+    args = parser.parse_args()
+    if args.command == 'local':
+        pd.DataFrame(summarize_local(args.paths)).to_csv(args.output, index=False)
+    else:
+        upload_companies(["Q32021", "Q42021", "Q12022", "Q22022", "Q32022", "Q42022", "Q12023", "Q22023"], ["BAC US", "C US", "GS US", "JPM US", "WFC US"], "Banks")
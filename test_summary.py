@@ -0,0 +1,133 @@
+import pandas as pd
+import pytest
+from google.cloud import datastore
+import summary
+
+# Parity of the offline summaries (summarize_local) with the Datastore path
+# (summarize_company_quarter). The same literal scores are written as local score files and
+# loaded as entities into an in-process fake client.
+
+# (company, period, call date, category, score, weighted score or None if unweighted)
+scores = [
+    ("WM US", "Q42022", "2022-10-26", "Macro", 0.5, 0.75),
+    ("WM US", "Q42022", "2022-10-26", "Macro", -0.3, None),
+    ("WM US", "Q42022", "2022-10-26", "Regulation", 0.2, 0.25),
+    ("WM US", "Q12023", "2023-02-01", "Sector trend", 0.9, 0.5),
+    ("WM US", "Q12023", "2023-02-01", "Financial metric - All", -0.6, None),
+    ("WM US", "Q12023", "2023-02-01", "Financial metric - All", 0.1, 1.0),
+    ("BAC US", "Q12023", "2023-01-13", "Financial metric - Bank", 0.4, 0.6),
+    ("BAC US", "Q12023", "2023-01-13", "Macro", -0.8, None),
+]
+
+# Score workbooks (eg example_scores.zip) have other column names and no weighted scores
+workbook_scores = [
+    ("GS US", "Q32022", "2022-10-18", "Macro", 0.3),
+    ("GS US", "Q32022", "2022-10-18", "Regulation", -0.1),
+    ("GS US", "Q32022", "2022-10-18", "Regulation", 0.7),
+]
+
+
+# Stands in for datastore.Client, answering equality-filtered queries from memory
+class FakeClient:
+    def __init__(self, entities):
+        self.entities = entities
+
+    def key(self, *path, namespace=None):
+        return datastore.Key(*path, project="test", namespace=namespace)
+
+    def query(self, kind):
+        return FakeQuery(self, kind)
+
+
+class FakeQuery:
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.filters = []
+
+    def add_filter(self, name, operator, value):
+        assert operator == "="
+        self.filters.append((name, value))
+        return self
+
+    def fetch(self):
+        return [
+            entity for entity in self.client.entities
+            if entity.key.kind == self.kind and all(entity.get(name) == value for name, value in self.filters)
+        ]
+
+
+def make_entities(kind, property_names):
+    '''
+    Input:
+        kind: The Datastore kind of the score entities
+        property_names: names of the (category, score, weighted score) properties
+
+    Returns:
+        An entity per literal score, without a weighted score property if unweighted
+    '''
+    category_name, score_name, weighted_name = property_names
+    entities = []
+    rows = scores + [(*row, None) for row in workbook_scores]
+    for i, (company, period, _, category, score, weighted) in enumerate(rows):
+        entity = datastore.Entity(datastore.Key(kind, i + 1, project="test"))
+        entity.update({"YahooTicker": company, "Period": period, category_name: category, score_name: score})
+        if weighted is not None:
+            entity[weighted_name] = weighted
+        entities.append(entity)
+    return entities
+
+
+def write_score_files(directory):
+    '''
+    Results:
+        Writes the literal scores to 'directory', as DataManager outputs ({company}_{date}.csv)
+        and as score workbooks (CC_{company}_Q{quarter}{year}_{month}_{day}_{year}.xlsx)
+    '''
+    frame = pd.DataFrame(scores, columns=["Company", "Period", "Date", "Key Word Category", "Score", "WeightedScore"])
+    for (company, date), rows in frame.groupby(["Company", "Date"]):
+        rows.assign(Paragraph="Some paragraph.", Magnitude=0.5, Keyword="keyword").drop(
+            columns=["Company", "Period", "Date"]
+        ).to_csv(directory / f"{company}_{date}.csv", index=False)
+
+    frame = pd.DataFrame(workbook_scores, columns=["Company", "Period", "Date", "Key Word Category", "Sentiment Score"])
+    for (company, period, date), rows in frame.groupby(["Company", "Period", "Date"]):
+        year, month, day = (int(part) for part in date.split("-"))
+        file_name = f"CC_{company}_{period}_{month}_{day}_{year}.xlsx"
+        rows.drop(columns=["Company", "Period", "Date"]).to_excel(directory / file_name, index=False)
+
+
+@pytest.mark.parametrize("property_names", [
+    ("Category", "Score", "WeightedSentiment"),
+    ("Key Word Category", "Score", "WeightedScore"),
+])
+def test_local_matches_datastore(monkeypatch, tmp_path, property_names):
+    write_score_files(tmp_path)
+    monkeypatch.setattr(summary, "client", FakeClient(make_entities("Test", property_names)))
+
+    local_summaries = summary.summarize_local([str(tmp_path)])
+    company_quarters = {(row[0], row[1]) for row in scores + workbook_scores}
+    assert {(row["Yahoo Ticker"], row["Period"]) for row in local_summaries} == company_quarters
+    for local_summary in local_summaries:
+        datastore_summary = summary.summarize_company_quarter(local_summary["Yahoo Ticker"], local_summary["Period"], "Test")
+        assert local_summary == pytest.approx(datastore_summary)
+
+
+def test_local_summary_values(tmp_path):
+    write_score_files(tmp_path)
+    local_summaries = {(row["Yahoo Ticker"], row["Period"]): row for row in summary.summarize_local([str(tmp_path)])}
+
+    wm = local_summaries[("WM US", "Q42022")]
+    assert wm["Macro Count"] == 2
+    assert wm["Macro Average"] == pytest.approx(0.1)
+    assert wm["Macro Weighted Average"] == pytest.approx(0.5)
+    assert wm["Regulation Weighted Average"] == pytest.approx(-0.5)
+    assert wm["Sector trend Count"] == 0
+    assert wm["Sector trend Average"] is None
+    assert wm["Total Average"] == pytest.approx(0.4 / 3)
+    assert wm["Weighted Average"] == pytest.approx(0.5 / 3)
+
+    gs = local_summaries[("GS US", "Q32022")]
+    assert gs["Regulation Count"] == 2
+    assert gs["Regulation Average"] == pytest.approx(0.3)
+    assert gs["Weighted Average"] == 0